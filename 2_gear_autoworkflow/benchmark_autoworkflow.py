@@ -0,0 +1,91 @@
+"""
+Benchmark the gear autoworkflow against an in-memory fake Flywheel site.
+
+Every simulated API call sleeps for `--latency` seconds, so the numbers show
+how the sweep scales with the number of worker threads when it is bound by
+round-trips to the server rather than by local compute.
+
+    python benchmark_autoworkflow.py --sessions 40 --latency 0.02 --workers 1 2 4 8 16
+
+`--steps N` instead compares API calls per session for an N-step template
+(every step already complete, so each step runs all of its checks) with the
+container cache and analysis index enabled vs. disabled.
+"""
+
+import os, sys
+import argparse
+import logging
+import time
+from pathlib import Path
+
+try:
+    absolute_path = os.path.abspath(__file__)
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
+except NameError:
+    sys.path.insert(0, os.path.dirname(os.getcwd()))
+from _helper_functions import gears
+from _helper_functions.fake_flywheel import make_fake_site
+
+
+BENCHMARK_TEMPLATE = {
+    "analysis": [
+        {"gear-name": "curate-bids", "gear-version": "2.1.3_1.0.7", "config": {}, "tags": []},
+        {"gear-name": "bids-mriqc", "gear-version": "1.2.4", "config": {}, "tags": [],
+         "prerequisites": [{"prereq-gear": "curate-bids", "prereq-complete-analysis": "any"}]},
+    ]
+}
+
+
+def chained_template(n_steps):
+    # step i requires step i-1, mimics a long preprocessing chain
+    steps = []
+    for i in range(n_steps):
+        step = {"gear-name": "gear-%d" % i, "gear-version": "1.0.0", "config": {}, "tags": []}
+        if i:
+            step["prerequisites"] = [{"prereq-gear": "gear-%d" % (i - 1), "prereq-complete-analysis": "any"}]
+        steps.append(step)
+    return {"analysis": steps}
+
+
+def benchmark_sweep(n_sessions, latency, workers, template=BENCHMARK_TEMPLATE, completed=False, cache_ttl=300):
+    fw, session_ids = make_fake_site(n_sessions, template, latency=latency)
+    if completed:
+        for sid in session_ids:
+            for step in template["analysis"]:
+                fw.add_analysis(sid, step["gear-name"], step["gear-version"])
+    gears.fw = fw
+
+    start = time.perf_counter()
+    summary = gears.run_auto_gear_sessions(session_ids, max_workers=workers, cache_ttl=cache_ttl)
+    elapsed = time.perf_counter() - start
+
+    return elapsed, fw.api_calls, summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per simulated API call")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--steps", type=int, help="compare API calls per session for a template with this many steps")
+    args = parser.parse_args()
+
+    logging.getLogger('main').setLevel(logging.WARNING)
+
+    if args.steps:
+        template = chained_template(args.steps)
+        print(f"{'mode':>10} {'seconds':>9} {'api calls':>10} {'calls/session':>14}")
+        for mode, ttl in (("uncached", 0), ("indexed", 300)):
+            elapsed, calls, summary = benchmark_sweep(args.sessions, args.latency, args.workers[0], template=template,
+                                                      completed=True, cache_ttl=ttl)
+            print(f"{mode:>10} {elapsed:>9.2f} {calls:>10} {calls / args.sessions:>14.1f}")
+        sys.exit(0)
+
+    print(f"{'workers':>8} {'seconds':>9} {'sessions/s':>11} {'api calls':>10} {'cache hits':>11} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        elapsed, calls, summary = benchmark_sweep(args.sessions, args.latency, workers)
+        baseline = baseline or elapsed
+        hits = summary["cache"]["total"]["hits"]
+        print(f"{workers:>8} {elapsed:>9.2f} {args.sessions / elapsed:>11.1f} {calls:>10} {hits:>11} {baseline / elapsed:>7.1f}x")
@@ -1,41 +1,75 @@
-import os
-import flywheel
+import os, sys
+import argparse
+from pathlib import Path
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger('main')
 
-# import custom helper functions, need to first add path to system envrionment... 
-#      do that using current directory inside jupyter notebooks, 
+# import custom helper functions, need to first add path to system envrionment...
+#      do that using current directory inside jupyter notebooks,
 #      or __file__ attribute in script
 try:
     absolute_path = os.path.abspath(__file__)
-    sys.path.insert(0, Path(absolute_path).parts[0:-2])
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
 except NameError:
     sys.path.insert(0, os.path.dirname(os.getcwd()))
 from _helper_functions import gears
+from _helper_functions.checkpoint import SweepCheckpoint
+from _helper_functions.client import get_client
 
 # set default permissions
 os.umask(0o002);
 
-# get flywheel client
-fw = flywheel.Client('')
+# get flywheel client (shared with the helper functions, see FW_CLIENT_METRICS)
+fw = get_client()
 
 
 if __name__ == "__main__":
-    
-    # locate sessions generated within lookback window
-    lookback = 7
-    created_by = gears.get_x_days_ago(lookback).strftime('%Y-%m-%d')
-    filtered_sessions=fw.sessions.find(f'created>{created_by}')
-
-    #Loop through sessions and see which ones apply for the gear rule to kick off
-    for session in filtered_sessions:
-        sid = session.id
-
-        log.info("checking workflow: %s/%s/%s",fw.get_project(fw.get_session(sid).parents["project"]).label, fw.get_session(sid).subject.label, fw.get_session(sid).label)
-
-        try:
-            gears.run_auto_gear(sid)
-        except Exception as e:
-            log.warning(e)
-    
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Apply the project gears template to recently created sessions.")
+    parser.add_argument("--lookback", type=int, default=7, help="check sessions created within this many days")
+    parser.add_argument("--workers", type=int, default=4, help="number of sessions evaluated in parallel")
+    parser.add_argument("--template", default="gears_template_JSON.txt", help="gears template project file name")
+    parser.add_argument("--submit-rate", type=float, help="queue all ready jobs and submit at most this many per second")
+    parser.add_argument("--submit-workers", type=int, default=4, help="job submissions in flight at the same time")
+    parser.add_argument("--checkpoint", help="sqlite file recording session state, only changed sessions are re-checked")
+    parser.add_argument("--project", help="check all sessions in this project (group/project) instead of the lookback window")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be submitted, submit nothing")
+    parser.add_argument("--plan-csv", help="with --dry-run, also write the plan table to this csv file")
+    args = parser.parse_args()
+
+    # locate sessions generated within lookback window (or all sessions in a project)
+    if args.project:
+        filtered_sessions=fw.lookup(args.project).sessions.find()
+    else:
+        created_by = gears.get_x_days_ago(args.lookback).strftime('%Y-%m-%d')
+        filtered_sessions=fw.sessions.find(f'created>{created_by}')
+
+    if args.dry_run:
+        plan, phases = gears.plan_auto_gear([session.id for session in filtered_sessions],
+                                            template_file_name=args.template, max_workers=args.workers)
+        print(plan.to_string(index=False))
+        print(phases.to_string(index=False))
+        if args.plan_csv:
+            plan.to_csv(args.plan_csv, index=False)
+        sys.exit(0)
+
+    # skip sessions that have not changed since the last sweep
+    checkpoint = SweepCheckpoint(args.checkpoint) if args.checkpoint else None
+    if checkpoint:
+        session_ids = gears.select_sessions_to_check(filtered_sessions, checkpoint, template_file_name=args.template)
+    else:
+        session_ids = [session.id for session in filtered_sessions]
+
+    # evaluate sessions in parallel and see which ones apply for the gear rule to kick off
+    summary = gears.run_auto_gear_sessions(session_ids,
+                                           template_file_name=args.template,
+                                           max_workers=args.workers,
+                                           submit_rate=args.submit_rate,
+                                           submit_workers=args.submit_workers,
+                                           checkpoint=checkpoint)
+
+    for sid, error in summary["errors"].items():
+        log.warning("Session %s: %s", sid, error)
+    for dest, errors in summary.get("submit_errors", {}).items():
+        log.warning("Submission to %s failed: %s", dest, "; ".join(errors))
@@ -0,0 +1,87 @@
+"""
+Benchmark utils.searchfiles against the `ls -d` subprocess it replaced.
+
+Builds a BIDS-like tree in a temporary directory and runs the same glob
+lookups with both implementations, checking that they return the same paths.
+The in-process version is timed with a cold and a warm directory index.
+
+    python benchmark_searchfiles.py --subjects 200 --repeat 20
+"""
+
+import os, sys
+import argparse
+import logging
+import tempfile
+import time
+import subprocess as sp
+from pathlib import Path
+
+try:
+    absolute_path = os.path.abspath(__file__)
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
+except NameError:
+    sys.path.insert(0, os.path.dirname(os.getcwd()))
+from _helper_functions import file_discovery
+
+
+def searchfiles_subprocess(path, dryrun=False, find_first=False):
+    # the previous implementation
+    cmd = "ls -d " + path
+    if not dryrun:
+        terminal = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        stdout, stderr = terminal.communicate()
+        files = stdout.strip("\n").split("\n")
+        if find_first:
+            files = files[0]
+        return files
+
+
+def make_tree(root, n_subjects, n_runs=4):
+    for s in range(n_subjects):
+        func = os.path.join(root, "sub-%03d" % s, "ses-01", "func")
+        os.makedirs(func)
+        for r in range(n_runs):
+            for suffix in ("bold.nii.gz", "bold.json", "events.tsv"):
+                open(os.path.join(func, "sub-%03d_ses-01_task-rest_run-%d_%s" % (s, r, suffix)), "w").close()
+
+
+def lookups(root, n_subjects):
+    # one per-subject lookup (the common batch pattern) plus a few tree-wide ones
+    per_subject = [os.path.join(root, "sub-%03d" % s, "ses-01", "func", "*_run-1_bold.nii.gz") for s in range(n_subjects)]
+    tree_wide = [os.path.join(root, "sub-*", "ses-01", "func", "*_events.tsv"),
+                 os.path.join(root, "sub-0[0-4]?", "ses-*", "func", "*.json")]
+    return per_subject + tree_wide
+
+
+def timed(fn, paths, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [fn(path) for path in paths]
+    return (time.perf_counter() - start) / (repeat * len(paths)), results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subjects", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5, help="passes over all lookups")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.subjects)
+        paths = lookups(root, args.subjects)
+
+        subprocess_s, expected = timed(searchfiles_subprocess, paths, args.repeat)
+        file_discovery._default_index.clear()
+        cold_s, cold = timed(file_discovery.searchfiles, paths, 1)
+        warm_s, warm = timed(file_discovery.searchfiles, paths, args.repeat)
+        # `ls` sorts by locale collation, searchfiles by code point
+        same = lambda results: [sorted(r) for r in results] == [sorted(r) for r in expected]
+        assert same(cold) and same(warm), "results differ from `ls -d`"
+
+        print(f"{len(paths)} lookups, {args.repeat} passes")
+        print(f"{'implementation':>22} {'ms/lookup':>10} {'speedup':>8}")
+        for name, seconds in [("ls -d subprocess", subprocess_s), ("scandir, cold index", cold_s),
+                              ("scandir, warm index", warm_s)]:
+            print(f"{name:>22} {seconds * 1e3:>10.3f} {subprocess_s / seconds:>7.1f}x")
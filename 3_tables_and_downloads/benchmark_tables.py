@@ -0,0 +1,69 @@
+"""
+Benchmark the reporting tables against an in-memory fake Flywheel site.
+
+Every simulated API call sleeps for `--latency` seconds, so the numbers show
+how building a table scales with the number of sessions fetched in parallel.
+`--workers 1` walks the project one session at a time, like the original
+implementation did.
+
+    python benchmark_tables.py --sessions 500 --latency 0.1 --workers 1 8 32
+"""
+
+import os, sys
+import argparse
+import logging
+import time
+from pathlib import Path
+
+try:
+    absolute_path = os.path.abspath(__file__)
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
+except NameError:
+    sys.path.insert(0, os.path.dirname(os.getcwd()))
+from _helper_functions import tables
+from _helper_functions.fake_flywheel import make_fake_site
+
+
+BENCHMARK_TEMPLATE = {
+    "analysis": [
+        {"gear-name": "curate-bids", "gear-version": "2.1.3_1.0.7", "config": {}, "tags": []},
+        {"gear-name": "bids-fmriprep", "gear-version": "1.2.16_20.2.6", "config": {}, "tags": []},
+        {"gear-name": "bids-mriqc", "gear-version": "1.2.4", "config": {}, "tags": []},
+    ]
+}
+
+
+def make_reporting_site(n_sessions, latency, template=BENCHMARK_TEMPLATE):
+    # every session has one completed analysis per template gear
+    fw, session_ids = make_fake_site(n_sessions, template, n_acquisitions=0, latency=latency)
+    for sid in session_ids:
+        for step in template["analysis"]:
+            fw.add_analysis(sid, step["gear-name"], step["gear-version"])
+    return fw
+
+
+def benchmark_gearname(fw, workers, gearname="bids-fmriprep"):
+    tables.fw = fw
+    fw.reset_calls()
+    start = time.perf_counter()
+    table = tables.get_table_by_gearname({"project": "benchmark", "group": "benchmark"}, gearname, max_workers=workers)
+    return time.perf_counter() - start, fw.api_calls, len(table)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per simulated API call")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    fw = make_reporting_site(args.sessions, args.latency)
+
+    print(f"{'workers':>8} {'seconds':>9} {'rows':>6} {'api calls':>10} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        elapsed, calls, rows = benchmark_gearname(fw, workers)
+        baseline = baseline or elapsed
+        print(f"{workers:>8} {elapsed:>9.2f} {rows:>6} {calls:>10} {baseline / elapsed:>7.1f}x")
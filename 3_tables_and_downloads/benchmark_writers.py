@@ -0,0 +1,98 @@
+"""
+Benchmark the csv and parquet table writers, and check the parquet round-trip.
+
+Writes the same synthetic reporting rows (strings, integers, floats,
+timestamps and empty cells, grouped by session) with both writers, then
+reads the parquet dataset back and checks that every value kept its type.
+A second parquet run is interrupted half way and resumed, and must end up
+with the same rows. The parquet part is skipped if pyarrow is not installed.
+
+    python benchmark_writers.py --sessions 5000 --rows-per-session 4
+"""
+
+import os, sys
+import argparse
+import logging
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+try:
+    absolute_path = os.path.abspath(__file__)
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
+except NameError:
+    sys.path.insert(0, os.path.dirname(os.getcwd()))
+from _helper_functions import writers
+
+COLUMNS = ["session.id", "subject.label", "session.timestamp", "analysis.label", "job.attempt", "job.hours", "Notes"]
+
+
+def make_rows(n_sessions, rows_per_session):
+    start = datetime(2024, 1, 1)
+    for s in range(n_sessions):
+        for r in range(rows_per_session):
+            yield {"session.id": "%024x" % s, "subject.label": "%03d" % (s // 2),
+                   "session.timestamp": start + timedelta(hours=s), "analysis.label": "bids-fmriprep %d" % r,
+                   "job.attempt": r + 1, "job.hours": None if r == 0 else 1.5 * r, "Notes": ""}
+
+
+def write(path, rows, **kwargs):
+    start = time.perf_counter()
+    with writers.table_writer(path, COLUMNS, key="session.id", **kwargs) as writer:
+        n = writer.write_rows(rows)
+    return time.perf_counter() - start, n
+
+
+def disk_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1e6
+    return sum(f.stat().st_size for f in os.scandir(path)) / 1e6
+
+
+def check_parquet(path, expected):
+    import pyarrow.parquet as pq
+    table = pq.read_table(path)
+    assert table.column_names == COLUMNS, table.column_names
+    rows = table.to_pylist()
+    assert rows == expected, "parquet rows differ from the rows written"
+    return table.schema
+
+
+def interrupted_run(path, rows, stop_after):
+    # the first writer is never closed, like a killed process: only its full parts are on disk
+    writer = writers.ParquetTableWriter(path, COLUMNS, key="session.id", rows_per_part=100)
+    for row in rows[:stop_after]:
+        writer.write(row)
+    writer = writers.ParquetTableWriter(path, COLUMNS, key="session.id", rows_per_part=100)
+    writer.write_rows(row for row in rows if row["session.id"] not in writer.done)
+    writer.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--rows-per-session", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    rows = list(make_rows(args.sessions, args.rows_per_session))
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [("csv",) + write(os.path.join(tmp, "table.csv"), rows) + (disk_mb(os.path.join(tmp, "table.csv")),)]
+        if writers.pq is None:
+            print("pyarrow is not installed, skipping the parquet writer")
+        else:
+            path = os.path.join(tmp, "table.parquet")
+            results.append(("parquet",) + write(path, rows) + (disk_mb(path),))
+            schema = check_parquet(path, rows)
+            resumed = os.path.join(tmp, "resumed.parquet")
+            interrupted_run(resumed, rows, len(rows) // 2 + 1)
+            check_parquet(resumed, rows)
+            print("parquet schema: " + ", ".join("%s: %s" % (field.name, field.type) for field in schema))
+            print("parquet round-trip and resume: ok")
+
+        print(f"{len(rows)} rows, {args.sessions} sessions")
+        print(f"{'writer':>8} {'seconds':>8} {'rows/s':>10} {'MB':>7}")
+        for name, seconds, n, mb in results:
+            print(f"{name:>8} {seconds:>8.2f} {n / seconds:>10.0f} {mb:>7.2f}")
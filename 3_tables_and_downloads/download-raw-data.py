@@ -1,57 +1,53 @@
 from pathlib import Path
 import sys, os
-import flywheel
 import pandas as pd
-import re
 
 import logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger('main')
 
+try:
+    absolute_path = os.path.abspath(__file__)
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
+except NameError:
+    sys.path.insert(0, os.path.dirname(os.getcwd()))
+from _helper_functions.client import get_client
+from _helper_functions.downloads import DownloadManager, get_cache
+from _helper_functions.bids_export import export_bids
+from _helper_functions.file_search import find_files
+from _helper_functions.manifest import Manifest
 
-def download_bids(project, path):
-    for ses in project.sessions.find():
-        full_session=fw.get_session(ses.id)  # this is necessary to pull the full object 
 
-        for acq in full_session.acquisitions():
-            full_acq = fw.get_acquisition(acq.id)   # this is necessary to pull the full object 
-            if "BIDS" not in full_acq.info.keys() or full_acq.info["BIDS"]["ignore"]:
-                continue
-            for fl in full_acq.files:
-                if "BIDS" in fl.info.keys():
-                    if fl.info["BIDS"]["ignore"]:
-                        continue
-                    bidspath = os.path.join(path,fl.info["BIDS"]["Path"],fl.info["BIDS"]["Filename"])
-                    os.makedirs(os.path.dirname(bidspath),exist_ok = True)
-                    fl.download(bidspath)
-                    log.info("Downloaded: %s", bidspath)
-    return
+def download_bids(project, path, max_workers=8):
+    # plans all (file, BIDS path) pairs concurrently, then downloads what is missing or changed
+    report = export_bids(project, path, max_workers=max_workers)
+    log.info("BIDS export: %s", report)
+    return report
 
 
-def download_file_by_pattern(project, path, pattern):
-    
-    pattern_compiled = re.compile(pattern)
-    
-    for ses in project.sessions.find():
-        full_session=fw.get_session(ses.id)  # this is necessary to pull the full object 
+def download_file_by_pattern(project, path, patterns, max_workers=8, use_search=True):
+    # patterns: one regex or a list, all resolved in one search query (or one walk of the project);
+    # matches are downloaded while the discovery is still running
+    queued = set()
+    manifest = Manifest(os.path.join(path, ".download_manifest.db"))   # resumes an interrupted run
+    with DownloadManager(max_workers=max_workers, manifest=manifest) as manager:
+        for match in find_files(project, patterns, use_search=use_search, max_workers=max_workers):
+            downloadpath = os.path.join(path, "sub-" + match.subject_label, "ses-" + match.session_label, "files")
+            dest = os.path.join(downloadpath, match.file.name)
+            if dest in queued:
+                continue    # matched by several patterns
+            queued.add(dest)
+            manager.download(match.file, dest)
+    for name, error in manager.errors.items():
+        log.error("Failed: %s (%s)", name, error)
+    report = manager.report()
+    manifest.close()
+    return report
 
-        for acq in full_session.acquisitions():
-            full_acq = fw.get_acquisition(acq.id)   # this is necessary to pull the full object 
 
-            for fl in full_acq.files:
-                if bool(re.search(pattern_compiled, fl.name)):
-                    downloadpath=os.path.join(path, "sub-"+full_session.subject.label,"ses-"+full_session.label,"files")
-                    os.makedirs(downloadpath,exist_ok=True)
-                    fl.download(os.path.join(downloadpath,fl["name"]))
-                    log.info("Downloaded: %s", os.path.join(downloadpath,fl["name"]))
-    
-    return
-    
-    
-                
 if __name__ == "__main__":
     #Setup the flywheel client
-    fw = flywheel.Client('')
+    fw = get_client()
     fw.get_config().site.api_url
 
     PROJECT_PATH = "<group/project>"   ## e.g.  project_path = "mbanich/ABCDQA"
@@ -62,9 +58,14 @@ if __name__ == "__main__":
     # path to download directory
     path='<path-to-downloads>'
     
-    # download bids files
-    download_bids(project, path)
+    # download bids files (files matching the previous export are skipped)
+    download_bids(project, path, max_workers=8)
     
-    # download file by pattern
-    pattern="recording"
-    download_file_by_pattern(project, path, pattern)
+    # download files by pattern (several patterns are resolved together)
+    patterns = ["recording"]
+    download_file_by_pattern(project, path, patterns, max_workers=8)
+
+    # repeated runs link files from the download cache (set FW_DOWNLOAD_CACHE to enable); linked files
+    # are read-only, set FW_DOWNLOAD_CACHE_COPY=1 if the pipeline modifies downloads in place
+    if get_cache():
+        log.info("Download cache: %s", get_cache().report())
@@ -5,7 +5,6 @@
 
 from pathlib import Path
 import os
-import flywheel
 import pandas as pd
 import sys
 import logging
@@ -14,19 +13,30 @@ log = logging.getLogger('main')
 
 try:
     absolute_path = os.path.abspath(__file__)
-    sys.path.insert(0, Path(absolute_path).parts[0:-2])
+    sys.path.insert(0, str(Path(absolute_path).parents[1]))
 except NameError:
     sys.path.insert(0, os.path.dirname(os.getcwd()))
 
 from _helper_functions import tables, fileIO
+from _helper_functions.client import get_client
+from _helper_functions.downloads import DownloadManager
+from _helper_functions.manifest import Manifest
 
 # set default permissions
 os.umask(0o002);
 
 download_path = "<download-path>"
 
+# number of files downloaded at the same time (across all analyses)
+max_workers = 8
+
+# only download matching files / zip members (globs or compiled regexes), None for everything
+#   e.g. include = ["*_desc-confounds_timeseries.tsv"]
+include = None
+exclude = None
+
 # get flywheel client
-fw = flywheel.Client('')
+fw = get_client()
 
 # download directly from list of analysis ids
 analysis_ids = [
@@ -37,6 +47,17 @@ analysis_ids = [
 # make sure download path exists (make if needed)
 os.makedirs(download_path, exist_ok=True)
 
-# download analysis files
-for aid in analysis_ids:
-    fileIO.download_session_analyses_byid(aid,download_path)
+# record of the downloaded files: a re-run (e.g. after the SLURM job was killed) skips
+# completed files, resumes partial ones and checks every file's checksum
+manifest = Manifest(os.path.join(download_path, ".download_manifest.db"))
+
+# download analysis files, all analyses share one pool of download workers
+with DownloadManager(max_workers=max_workers, manifest=manifest) as manager:
+    for aid in analysis_ids:
+        fileIO.download_session_analyses_byid(aid, download_path, manager=manager, include=include, exclude=exclude)
+
+for name, error in manager.errors.items():
+    log.error("Failed: %s (%s)", name, error)
+log.info("Downloaded %s files, %s MB at %s MB/s", manager.stats.files, round(manager.stats.bytes / 1e6, 1), round(manager.stats.mb_per_s, 2))
+log.info("Manifest: %s", manifest.report())
+manifest.close()
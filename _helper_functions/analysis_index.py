@@ -0,0 +1,89 @@
+import re
+import logging
+from collections import defaultdict, namedtuple
+
+log = logging.getLogger(__name__)
+
+
+AnalysisRecord = namedtuple("AnalysisRecord", ["gear_name", "gear_version", "label", "state", "level", "analysis"])
+
+
+class AnalysisIndex:
+    """In-memory index of the analyses attached to a session and its acquisitions.
+
+    Analyses are fetched once and indexed by gear name; each record keeps the
+    gear version, analysis label, job state and the container level it was
+    found on. Query results are memoized, so repeated template checks against
+    the same session are answered without rescanning or new API calls.
+
+    Args:
+        records (list): AnalysisRecord entries (see `from_session`).
+    """
+
+    def __init__(self, records):
+        self.records = list(records)
+        self._by_gear = defaultdict(list)
+        for record in self.records:
+            self._by_gear[record.gear_name].append(record)
+        self._patterns = {}
+        self._queries = {}
+
+    @staticmethod
+    def _records(analyses, level):
+        for analysis in analyses:
+            if not analysis.gear_info:
+                continue
+            job = analysis.job
+            state = job.state if hasattr(job, 'state') else None
+            yield AnalysisRecord(analysis.gear_info.name, analysis.gear_info["version"], analysis.label, state, level, analysis)
+
+    @classmethod
+    def from_session(cls, session, client):
+        """Builds the index from a full session object plus all of its acquisitions.
+
+        Args:
+            session (flywheel.Session): full session object (use fw.get_session(session.id)).
+            client (flywheel.Client): client used to pull full acquisition objects.
+        """
+        records = list(cls._records(session.analyses, "session"))
+        for acq in session.acquisitions.find():
+            records += cls._records(client.get_acquisition(acq.id).analyses, "acquisition")
+        return cls(records)
+
+    def _version_pattern(self, gear_version):
+        if gear_version not in self._patterns:
+            self._patterns[gear_version] = re.compile(gear_version)
+        return self._patterns[gear_version]
+
+    def find(self, gear_info, analysis_label=None, level=None):
+        """Returns the records matching a gear and optional label.
+
+        Args:
+            gear_info (str): gear name, or "name/version" where version is a regular expression.
+            analysis_label (str): only keep analyses whose label contains this text.
+            level (str): only keep analyses found at this level ("session" | "acquisition").
+
+        Returns:
+            tuple: matching AnalysisRecord entries, in the order they were attached.
+        """
+        key = (gear_info, analysis_label, level)
+        if key in self._queries:
+            return self._queries[key]
+
+        if "/" in gear_info:
+            gear_name, gear_version = gear_info.split("/")[0:2]
+        else:
+            gear_name, gear_version = gear_info, None
+
+        matches = []
+        for record in self._by_gear.get(gear_name, ()):
+            if gear_version and not self._version_pattern(gear_version).search(record.gear_version):
+                continue
+            if analysis_label and analysis_label not in record.label:
+                continue
+            if level and record.level != level:
+                continue
+            matches.append(record)
+
+        self._queries[key] = tuple(matches)
+        return self._queries[key]
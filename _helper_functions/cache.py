@@ -0,0 +1,76 @@
+import threading
+import time
+import logging
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+
+class ContainerCache:
+    """Request-scoped cache for flywheel containers and gears.
+
+    Entries expire after `ttl` seconds and can be dropped explicitly with
+    `invalidate` (e.g. after submitting a job to a session). Hit and miss
+    counters are kept per entry kind so a sweep can report how many API
+    round-trips were saved.
+
+    Args:
+        client (flywheel.Client): client used to fetch entries on a miss.
+        ttl (float): seconds an entry stays valid.
+    """
+
+    def __init__(self, client, ttl=300):
+        self.client = client
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+        self._store = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, key, fetch):
+        """Returns the cached entry for (kind, key), calling `fetch()` on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._store.get((kind, key))
+            if entry and entry[0] > now:
+                self.hits[kind] += 1
+                return entry[1]
+            self.misses[kind] += 1
+
+        value = fetch()
+        with self._lock:
+            self._store[(kind, key)] = (now + self.ttl, value)
+        return value
+
+    def get_container(self, cid):
+        return self.get("container", cid, lambda: self.client.get_container(cid))
+
+    def get_project(self, pid):
+        return self.get("project", pid, lambda: self.client.get_project(pid))
+
+    def get_session(self, sid):
+        return self.get("session", sid, lambda: self.client.get_session(sid))
+
+    def get_acquisition(self, aid):
+        return self.get("acquisition", aid, lambda: self.client.get_acquisition(aid))
+
+    def lookup_gear(self, gear_name):
+        return self.get("gear", gear_name, lambda: self.client.lookup("gears/" + gear_name))
+
+    def invalidate(self, kind=None, key=None):
+        """Drops cached entries: one entry, all entries of a kind, or everything."""
+        with self._lock:
+            if kind is None:
+                self._store.clear()
+            elif key is None:
+                for k in [k for k in self._store if k[0] == kind]:
+                    del self._store[k]
+            else:
+                self._store.pop((kind, key), None)
+
+    def stats(self):
+        """Returns hit/miss counts per entry kind, plus totals."""
+        kinds = sorted(set(self.hits) | set(self.misses))
+        stats = {kind: {"hits": self.hits[kind], "misses": self.misses[kind]} for kind in kinds}
+        stats["total"] = {"hits": sum(self.hits.values()), "misses": sum(self.misses.values())}
+        return stats
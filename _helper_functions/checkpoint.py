@@ -0,0 +1,78 @@
+import sqlite3
+import logging
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+class SweepCheckpoint:
+    """Local SQLite record of what the autoworkflow saw at each session's last evaluation.
+
+    For every session it keeps the template version, the session's `modified`
+    timestamp, the latest `modified` timestamp of its analyses, and whether
+    anything was left pending (a job submitted, or a step blocked on its
+    prerequisites / completeness conditions). A session only needs to be
+    checked again if one of these changed or something was left pending.
+
+    Args:
+        path (str): sqlite database file, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                template_version TEXT,
+                session_modified TEXT,
+                analyses_modified TEXT,
+                pending INTEGER,
+                evaluated TEXT
+            )""")
+        self._db.commit()
+
+    def get(self, session_id):
+        row = self._db.execute(
+            "SELECT template_version, session_modified, analyses_modified, pending FROM sessions WHERE session_id = ?",
+            (session_id,)).fetchone()
+        if not row:
+            return None
+        return {"template_version": row[0], "session_modified": row[1], "analyses_modified": row[2], "pending": bool(row[3])}
+
+    def needs_check(self, session_id, template_version, session_modified, analyses_modified=None):
+        """Returns True unless the session is unchanged since a fully settled evaluation.
+
+        Args:
+            session_id (str): flywheel session id.
+            template_version (str): version of the gears template that would be applied.
+            session_modified (datetime): session `modified` timestamp as seen now.
+            analyses_modified (datetime): latest analysis `modified` timestamp, None if not known.
+        """
+        last = self.get(session_id)
+        if not last or last["pending"]:
+            return True
+        if last["template_version"] != template_version:
+            return True
+        if last["session_modified"] != _timestamp(session_modified):
+            return True
+        if analyses_modified is not None and last["analyses_modified"] != _timestamp(analyses_modified):
+            return True
+        return False
+
+    def record(self, session_id, template_version, session_modified, analyses_modified, pending):
+        """Stores the state of a session as seen at the end of its evaluation."""
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+            (session_id, template_version, _timestamp(session_modified), _timestamp(analyses_modified),
+             int(bool(pending)), datetime.now().isoformat()))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
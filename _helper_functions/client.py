@@ -0,0 +1,206 @@
+"""
+Shared, instrumented flywheel client.
+
+All helper modules get their client from `get_client()`, so one script talks
+to Flywheel through a single client, and every request it makes is counted.
+Calls are recorded at the SDK's HTTP layer. This covers calls made through
+container objects (e.g. `session.acquisitions.find()`) as well as calls made
+on the client itself, so call sites do not need to change.
+
+Set FW_CLIENT_METRICS=/path/metrics.json (or .prom) to dump the metrics when
+the script exits, or call `export_metrics()` yourself.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import flywheel
+
+from _helper_functions import profiling
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+_client = None
+_client_lock = threading.Lock()
+_local = threading.local()
+
+
+class ClientMetrics:
+    """Per-endpoint request counts, errors, latency histograms and bytes transferred."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = defaultdict(lambda: {"count": 0, "errors": 0, "seconds": 0.0,
+                                              "bytes_sent": 0, "bytes_received": 0,
+                                              "buckets": [0] * len(LATENCY_BUCKETS)})
+
+    def record(self, endpoint, seconds, bytes_sent=0, bytes_received=0, error=False):
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats["count"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += bytes_received
+            for i, upper in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper:
+                    stats["buckets"][i] += 1
+                    break
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+    def to_dict(self):
+        """Returns the metrics as plain data, busiest endpoint first."""
+        with self._lock:
+            endpoints = {name: dict(stats, buckets=dict(zip([str(b).replace("inf", "+Inf") for b in LATENCY_BUCKETS], stats["buckets"])))
+                         for name, stats in sorted(self.endpoints.items(), key=lambda kv: -kv[1]["count"])}
+        return {
+            "total_requests": sum(e["count"] for e in endpoints.values()),
+            "total_seconds": sum(e["seconds"] for e in endpoints.values()),
+            "bytes_sent": sum(e["bytes_sent"] for e in endpoints.values()),
+            "bytes_received": sum(e["bytes_received"] for e in endpoints.values()),
+            "endpoints": endpoints,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            items = sorted(self.endpoints.items())
+            series = [
+                ("flywheel_api_requests_total", "counter", "Requests sent to the Flywheel API.", "count"),
+                ("flywheel_api_errors_total", "counter", "Requests that raised an error.", "errors"),
+                ("flywheel_api_bytes_sent_total", "counter", "Request body bytes sent.", "bytes_sent"),
+                ("flywheel_api_bytes_received_total", "counter", "Response body bytes received.", "bytes_received"),
+            ]
+            for name, kind, help_text, key in series:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines += [f'{name}{{endpoint="{endpoint}"}} {stats[key]}' for endpoint, stats in items]
+
+            name = "flywheel_api_request_seconds"
+            lines += [f"# HELP {name} Request latency in seconds.", f"# TYPE {name} histogram"]
+            for endpoint, stats in items:
+                cumulative = 0
+                for upper, n in zip(LATENCY_BUCKETS, stats["buckets"]):
+                    cumulative += n
+                    le = "+Inf" if upper == float("inf") else upper
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {stats["seconds"]:.6f}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = ClientMetrics()
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    return len(json.dumps(body, default=str).encode("utf-8"))
+
+
+def _file_sizes(files):
+    # call_api `files` maps form field -> path (or list of paths)
+    total = 0
+    for value in (files or {}).values():
+        for path in value if isinstance(value, (list, tuple)) else [value]:
+            if isinstance(path, str) and os.path.isfile(path):
+                total += os.path.getsize(path)
+    return total
+
+
+def instrument(client, client_metrics=None):
+    """Records every request made through `client` into `client_metrics` (default: shared metrics).
+
+    Wraps the SDK's `api_client.call_api`, which every client and container method goes
+    through, to get the endpoint name and latency. Also wraps `rest_client.request`, which
+    returns the raw response, to get the number of bytes transferred. Returns the client.
+    """
+    client_metrics = client_metrics or metrics
+    api_client = getattr(client, "api_client", None)
+    if api_client is None or getattr(api_client, "_fw_instrumented", False):
+        return client
+
+    call_api = api_client.call_api
+
+    def instrumented_call_api(resource_path, method, *args, **kwargs):
+        _local.bytes_sent = _file_sizes(kwargs.get("files"))
+        _local.bytes_received = 0
+        endpoint = f"{method} {resource_path}"
+        error = False
+        start = time.perf_counter()
+        try:
+            return call_api(resource_path, method, *args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            client_metrics.record(endpoint, time.perf_counter() - start,
+                                  getattr(_local, "bytes_sent", 0), getattr(_local, "bytes_received", 0), error)
+            profiling.record_api_call(endpoint)
+
+    api_client.call_api = instrumented_call_api
+
+    rest_client = getattr(api_client, "rest_client", None)
+    if rest_client is not None:
+        request = rest_client.request
+
+        def instrumented_request(method, url, *args, **kwargs):
+            response = request(method, url, *args, **kwargs)
+            _local.bytes_sent = getattr(_local, "bytes_sent", 0) + _body_size(kwargs.get("body"))
+            data = getattr(response, "data", None)
+            if isinstance(data, (bytes, bytearray, str)):
+                _local.bytes_received = getattr(_local, "bytes_received", 0) + len(data)
+            elif hasattr(response, "getheader") and response.getheader("Content-Length"):
+                _local.bytes_received = getattr(_local, "bytes_received", 0) + int(response.getheader("Content-Length"))
+            return response
+
+        rest_client.request = instrumented_request
+
+    api_client._fw_instrumented = True
+    return client
+
+
+def is_instrumented(client):
+    return getattr(getattr(client, "api_client", None), "_fw_instrumented", False)
+
+
+def get_client(api_key=''):
+    """Returns the shared, instrumented flywheel client, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = instrument(flywheel.Client(api_key))
+            if os.environ.get("FW_CLIENT_METRICS"):
+                atexit.register(export_metrics, os.environ["FW_CLIENT_METRICS"])
+    return _client
+
+
+def export_metrics(path=None, fmt=None):
+    """Writes the shared metrics to `path` as JSON, or Prometheus text for *.prom / *.txt files.
+
+    Returns the text written (also when no path is given).
+    """
+    fmt = fmt or ("prometheus" if path and path.endswith((".prom", ".txt")) else "json")
+    text = metrics.to_prometheus() if fmt == "prometheus" else metrics.to_json()
+    if path:
+        with open(path, "w") as f:
+            f.write(text)
+        log.info("Flywheel API metrics: %s requests written to %s", metrics.to_dict()["total_requests"], path)
+    return text
@@ -0,0 +1,348 @@
+"""
+Concurrent, resumable file downloads.
+
+Files are streamed from their ticketed download url into `<dest>.part` and
+renamed once complete. An interrupted transfer continues where it stopped
+with an HTTP Range request (or starts over if the server ignores the range),
+and files already present with the expected size are not downloaded again.
+Files without a download url fall back to the sdk's `file.download()`.
+
+    with DownloadManager(max_workers=8) as manager:
+        for fl in analysis.files:
+            manager.download(fl, os.path.join(path, fl.name))
+    log.info(manager.report())
+
+Pass a `manifest.Manifest` to record every file and resume a killed run.
+"""
+
+import os
+import time
+import logging
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from _helper_functions.file_cache import FileCache
+from _helper_functions.manifest import PENDING, IN_FLIGHT, DONE, parse_hash, file_digest
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def use_cache(cache):
+    """Routes all downloads made through fetch_file via `cache` (a FileCache, None to disable)."""
+    global _cache
+    _cache = cache
+    return cache
+
+
+def get_cache():
+    """Returns the active download cache, created from FW_DOWNLOAD_CACHE(_GB, _COPY) on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None and os.environ.get("FW_DOWNLOAD_CACHE"):
+            max_gb = float(os.environ.get("FW_DOWNLOAD_CACHE_GB", 100))
+            _cache = FileCache(os.environ["FW_DOWNLOAD_CACHE"], max_bytes=int(max_gb * 1024 ** 3),
+                               copy=os.environ.get("FW_DOWNLOAD_CACHE_COPY", "") not in ("", "0"))
+    return _cache
+
+
+class DownloadStats:
+    """Thread-safe byte / file counters for a batch of downloads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.bytes = 0
+        self.files = 0
+        self.skipped = 0
+
+    def add_bytes(self, n):
+        with self._lock:
+            self.bytes += n
+
+    def add_file(self, skipped=False):
+        with self._lock:
+            self.files += 1
+            self.skipped += int(skipped)
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def mb_per_s(self):
+        return self.bytes / 1e6 / max(self.seconds, 1e-9)
+
+    def report(self):
+        return {"files": self.files, "skipped": self.skipped, "MB": round(self.bytes / 1e6, 1),
+                "seconds": round(self.seconds, 1), "MB/s": round(self.mb_per_s, 2)}
+
+
+def _file_url(file_entry):
+    # ticketed download url, None if the object cannot provide one
+    try:
+        return file_entry.url()
+    except Exception:
+        return None
+
+
+def fetch_file(file_entry, dest, stats=None, chunk_size=CHUNK_SIZE, retries=3, timeout=600):
+    """Downloads one flywheel file to `dest`, resuming a previous partial transfer.
+
+    An existing `dest` of the expected size is kept only if it also matches the
+    flywheel hash (or, for files without a hash, is newer than the flywheel file).
+    With a download cache enabled (see use_cache), files already in the cache are
+    linked into `dest` instead of being downloaded. A hardlinked `dest` is read-only
+    and a symlinked one dangles once the cache evicts the file, unless the cache
+    places copies (FileCache(copy=True), FW_DOWNLOAD_CACHE_COPY=1).
+
+    Args:
+        file_entry (flywheel.FileEntry): file to download.
+        dest (str): destination path.
+        stats (DownloadStats): counters to update.
+        chunk_size (int): bytes read per request chunk.
+        retries (int): attempts per file, a new attempt continues from the bytes already on disk.
+        timeout (float): socket timeout in seconds.
+
+    Returns:
+        int: bytes transferred.
+    """
+    if _already_downloaded(file_entry, dest):
+        log.debug("%s already downloaded", dest)
+        if stats:
+            stats.add_file(skipped=True)
+        return 0
+
+    def transfer(file_entry, path):
+        return _transfer(file_entry, path, stats, chunk_size, retries, timeout)
+
+    cache = get_cache()
+    received = cache.fetch(file_entry, dest, transfer) if cache else transfer(file_entry, dest)
+    if stats:
+        stats.add_file()
+    return received
+
+
+def _already_downloaded(file_entry, dest):
+    # same size is not enough: compare the flywheel hash, or without one, the modification times
+    size = getattr(file_entry, "size", None)
+    if size is None or not os.path.isfile(dest) or os.path.getsize(dest) != size:
+        return False
+    algorithm, digest = parse_hash(getattr(file_entry, "hash", None))
+    if digest is not None:
+        return file_digest(dest, algorithm) == digest
+    try:
+        return os.path.getmtime(dest) >= file_entry.modified.timestamp()
+    except (AttributeError, TypeError):
+        return False
+
+
+def _transfer(file_entry, dest, stats, chunk_size, retries, timeout):
+    size = getattr(file_entry, "size", None)
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    part = dest + ".part"
+    received = 0
+    for attempt in range(retries):
+        url = _file_url(file_entry)
+        if url is None:
+            file_entry.download(dest)
+            received = os.path.getsize(dest)
+            if stats:
+                stats.add_bytes(received)
+            break
+
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        if size is not None and offset == size:
+            break
+        if size is not None and offset > size:
+            # left over from another version of the file
+            log.warning("Discarding %s (%s bytes, expected %s)", part, offset, size)
+            os.remove(part)
+            offset = 0
+        request = urllib.request.Request(url, headers={"Range": "bytes=%s-" % offset} if offset else {})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                if offset and response.status != 206:
+                    offset = 0    # range not supported, start over
+                with open(part, "ab" if offset else "wb") as f:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        received += len(chunk)
+                        if stats:
+                            stats.add_bytes(len(chunk))
+            got = os.path.getsize(part)
+            if size is None or got == size:
+                break
+            if got > size:
+                os.remove(part)
+            raise IOError("incomplete transfer of %s (%s of %s bytes)" % (dest, got, size))
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset:
+                if size is None or os.path.getsize(part) == size:    # nothing left to fetch
+                    break
+                # the partial file does not belong to this file, start over
+                log.warning("Discarding %s (%s bytes, expected %s)", part, os.path.getsize(part), size)
+                os.remove(part)
+                continue
+            if attempt == retries - 1:
+                raise
+            log.warning("Download of %s failed (%s), retrying...", dest, e)
+        except (urllib.error.URLError, IOError) as e:
+            if attempt == retries - 1:
+                raise
+            log.warning("Download of %s interrupted (%s), resuming...", dest, e)
+        time.sleep(2 ** attempt)
+    else:
+        raise IOError("could not download %s in %s attempts" % (dest, retries))
+
+    if os.path.isfile(part):
+        os.replace(part, dest)
+    return received
+
+
+class DownloadManager:
+    """Runs file downloads (and other transfer tasks) on a bounded thread pool.
+
+    With a manifest, files recorded as done or verified (and unchanged on disk)
+    are skipped, every other file is tracked through the manifest states, and
+    completed files are checksummed on a separate pool of `verify_workers` threads.
+
+    Args:
+        max_workers (int): number of transfers running at the same time.
+        chunk_size (int): bytes read per request chunk.
+        retries (int): attempts per file.
+        manifest (Manifest): download manifest to resume from and record into.
+        verify (bool): check the checksum of every downloaded file (needs a manifest).
+        verify_workers (int): number of files checksummed at the same time.
+        progress_every (float): seconds between progress log lines (remaining MB, ETA).
+    """
+
+    def __init__(self, max_workers=4, chunk_size=CHUNK_SIZE, retries=3, manifest=None, verify=True,
+                 verify_workers=2, progress_every=60):
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.manifest = manifest
+        self.verify = verify and manifest is not None
+        self.progress_every = progress_every
+        self.stats = DownloadStats()
+        self.errors = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._last_progress = time.perf_counter()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._verify_pool = ThreadPoolExecutor(max_workers=max(1, verify_workers)) if self.verify else None
+
+    def download(self, file_entry, dest):
+        """Queues one file download; returns a Future (bytes transferred)."""
+        if self.manifest is None:
+            return self.submit(dest, fetch_file, file_entry, dest, self.stats, self.chunk_size, self.retries)
+        return self.submit_file(file_entry, dest, self._fetch, file_entry, dest)
+
+    def _fetch(self, file_entry, dest, attempt=0):
+        received = fetch_file(file_entry, dest, self.stats, self.chunk_size, self.retries)
+        self.manifest.set_state(dest, DONE)
+        if self.verify:
+            self._add_future(dest, self._verify_pool.submit(self._verify, file_entry, dest, attempt))
+        return received
+
+    def _verify(self, file_entry, dest, attempt):
+        if self.manifest.verify(dest):
+            return
+        if attempt >= 1:
+            raise IOError("checksum mismatch for %s" % dest)
+        log.warning("Checksum mismatch for %s, downloading it again", dest)
+        os.remove(dest)
+        if get_cache():
+            get_cache().discard(file_entry)    # or the retry would link the same object again
+        self.manifest.set_state(dest, IN_FLIGHT)
+        self._add_future(dest, self._pool.submit(self._tracked, dest, self._fetch, file_entry, dest, attempt + 1))
+
+    def submit_file(self, file_entry, name, fn, *args, **kwargs):
+        """Queues a task producing a flywheel file (e.g. download + unzip), tracked in the manifest as `name`.
+
+        Returns a completed Future (result 0) if the manifest records it as done.
+        """
+        if self.manifest is not None and self.manifest.is_complete(file_entry, name):
+            self.stats.add_file(skipped=True)
+            future = Future()
+            future.set_result(0)
+            return future
+        if self.manifest is not None:
+            self.manifest.add(file_entry, name)
+        return self.submit(name, self._tracked, name, fn, *args, **kwargs)
+
+    def _tracked(self, name, fn, *args, **kwargs):
+        if self.manifest is None:
+            return fn(*args, **kwargs)
+        self.manifest.set_state(name, IN_FLIGHT)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.manifest.set_state(name, PENDING)
+            raise
+        if self.manifest.entry(name)["state"] == IN_FLIGHT:    # not set by the task itself
+            self.manifest.set_state(name, DONE)
+        self._log_progress()
+        return result
+
+    def submit(self, name, fn, *args, **kwargs):
+        """Queues any transfer task (e.g. download + unzip); `name` identifies it in `errors`."""
+        future = self._pool.submit(fn, *args, **kwargs)
+        self._add_future(name, future)
+        return future
+
+    def _add_future(self, name, future):
+        with self._lock:
+            self._futures[future] = name
+
+    def _log_progress(self):
+        with self._lock:
+            if time.perf_counter() - self._last_progress < self.progress_every:
+                return
+            self._last_progress = time.perf_counter()
+        log.info("Download progress: %s", self.report())
+
+    def wait(self):
+        """Blocks until all queued tasks (and checksum checks) finished; returns the errors by task name."""
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                return self.errors
+            done, _ = wait(futures)
+            for future in done:
+                with self._lock:
+                    name = self._futures.pop(future)
+                if future.exception():
+                    log.error("Download of %s failed: %s", name, future.exception())
+                    self.errors[name] = future.exception()
+
+    def report(self):
+        report = dict(self.stats.report(), errors=len(self.errors))
+        if self.manifest is not None:
+            report["manifest"] = self.manifest.report(self.stats.mb_per_s)
+        if get_cache():
+            report["cache"] = get_cache().report()
+        return report
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
+        if self._verify_pool:
+            self._verify_pool.shutdown()
+        log.info("Downloads: %s", self.report())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,337 @@
+"""
+A small in-memory stand-in for the flywheel sdk client.
+
+Used by the benchmark scripts to exercise the helper functions without a
+Flywheel site. Every "API" method sleeps for a configurable latency and is
+counted, so round-trips and throughput can be compared between code paths.
+"""
+
+import threading
+import time
+import json
+import hashlib
+import re
+from collections import Counter
+from datetime import datetime
+from itertools import count
+
+
+class FakeObject(dict):
+    """dict with attribute access, mimics flywheel model objects."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class FakeFile(FakeObject):
+
+    def read(self):
+        return self["content"]
+
+    def download(self, dest):
+        with open(dest, "wb") as f:
+            f.write(self["content"])
+
+
+def fake_file(name, content=b"", info=None):
+    """Builds a FakeFile with flywheel's size and `v0-sha384-<hex>` hash fields."""
+    return FakeFile(name=name, content=content, info=info or {}, size=len(content), version=1,
+                    hash="v0-sha384-" + hashlib.sha384(content).hexdigest())
+
+
+class FakeFinder:
+    """Mimics `container.acquisitions` / `fw.sessions` finders."""
+
+    def __init__(self, client, method, items):
+        self._client = client
+        self._method = method
+        self._items = items
+
+    def find(self, *args, **kwargs):
+        self._client._api_call(self._method)
+        return [self._client._snapshot(x) for x in self._items()]
+
+    def find_one(self, filter_str=""):
+        # only the `label=...,group=...` filters used by the helper functions
+        wanted = dict(term.split("=", 1) for term in filter_str.split(",") if "=" in term)
+        self._client._api_call(self._method.replace(".find", ".find_one"))
+        for item in self._items():
+            if all(item.get(key) == value for key, value in wanted.items()):
+                return self._client._snapshot(item)
+        raise ValueError("no container matches %s" % filter_str)
+
+    def __call__(self):
+        return self.find()
+
+
+class FakeJobFinder:
+    """Mimics `fw.jobs`, supports the `id=|[...]` (in list) filter."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def find(self, filter_str="", limit=None):
+        self._client._api_call("jobs.find")
+        self._client.advance_jobs()
+        jobs = self._client._jobs
+        if filter_str.startswith("id=|["):
+            ids = filter_str[len("id=|["):-1].split(",")
+            found = [FakeObject(jobs[jid]) for jid in ids if jid in jobs]
+        else:
+            found = [FakeObject(job) for job in jobs.values()]
+        return found[:limit] if limit else found
+
+
+class FakeGear(FakeObject):
+
+    def run(self, analysis_label=None, config=None, inputs=None, tags=None, destination=None):
+        client = self["_client"]
+        client._api_call("gear.run")
+        return client.add_analysis(destination.id, self["gear"]["name"], self["gear"]["version"],
+                                   label=analysis_label, state="pending")
+
+
+class FakeClient:
+    """In-memory flywheel client with injected latency.
+
+    Args:
+        latency (float): seconds slept for every simulated API round-trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._ids = count()
+        self._containers = {}
+        self._jobs = {}
+        self._gears = {}
+        self.sessions = FakeFinder(self, "sessions.find", self._sessions)
+        self.projects = FakeFinder(self, "projects.find", self._projects)
+        self.jobs = FakeJobFinder(self)
+        self._job_runtime = None
+        self.search_enabled = True
+
+    # ------------------------------- #
+    # ---------- bookkeeping -------- #
+    # ------------------------------- #
+
+    def _api_call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _new_id(self):
+        return "%024x" % next(self._ids)
+
+    def _sessions(self):
+        return [c for c in self._containers.values() if c["container_type"] == "session"]
+
+    def _projects(self):
+        return [c for c in self._containers.values() if c["container_type"] == "project"]
+
+    def _snapshot(self, container):
+        # flywheel returns a fresh object on every fetch, copy the mutable lists
+        snap = FakeObject(container)
+        for key in ("analyses", "files", "tags"):
+            if key in snap:
+                snap[key] = list(snap[key])
+        if container["container_type"] in ("session", "project"):
+            snap["acquisitions"] = FakeFinder(self, "acquisitions.find", lambda: [
+                c for c in self._containers.values()
+                if c["container_type"] == "acquisition" and c["parents"].get(container["container_type"]) == container["id"]])
+        if container["container_type"] == "project":
+            snap["sessions"] = FakeFinder(self, "sessions.find", lambda: [
+                c for c in self._sessions() if c["project"] == container["id"]])
+        if "files" in snap:
+            snap["get_file"] = lambda name: next((f for f in snap["files"] if f["name"] == name), None)
+        return snap
+
+    @property
+    def api_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    # ------------------------------- #
+    # --------- site builder -------- #
+    # ------------------------------- #
+
+    def add_project(self, label, files=(), group="benchmark"):
+        pid = self._new_id()
+        self._containers[pid] = FakeObject(id=pid, label=label, group=group, container_type="project", parents={},
+                                           files=[FakeFile(name=f, content=c, modified=datetime.now()) for f, c in files],
+                                           info={})
+        return pid
+
+    def add_subject(self, project_id, label):
+        sid = self._new_id()
+        self._containers[sid] = FakeObject(id=sid, label=label, container_type="subject",
+                                           parents={"project": project_id}, files=[], info={})
+        return sid
+
+    def add_session(self, subject_id, label, info=None, tags=None, timestamp=None):
+        subject = self._containers[subject_id]
+        sid = self._new_id()
+        self._containers[sid] = FakeObject(
+            id=sid, label=label, container_type="session", project=subject["parents"]["project"],
+            parents={"project": subject["parents"]["project"], "subject": subject_id},
+            subject=FakeObject(id=subject_id, label=subject["label"]),
+            info=info or {}, tags=tags or [], notes=[], files=[], analyses=[],
+            timestamp=timestamp or datetime.now(), created=datetime.now(), modified=datetime.now())
+        return sid
+
+    def add_acquisition(self, session_id, label, files=(), info=None):
+        # files: names, or (name, content, info) tuples
+        session = self._containers[session_id]
+        aid = self._new_id()
+        self._containers[aid] = FakeObject(
+            id=aid, label=label, container_type="acquisition",
+            parents=dict(session["parents"], session=session_id),
+            files=[fake_file(*f) if isinstance(f, tuple) else fake_file(f) for f in files], analyses=[], info=info or {})
+        return aid
+
+    def add_gear(self, name, version):
+        gear = FakeGear(gear={"name": name, "version": version}, _client=self)
+        self._gears[name + "/" + version] = gear
+        self._gears.setdefault(name, gear)
+        return gear
+
+    def add_analysis(self, parent_id, gear_name, gear_version, label=None, state="complete"):
+        parent = self._containers[parent_id]
+        analysis_id = self._new_id()
+        job = FakeObject(id=self._new_id(), state=state, destination={"id": analysis_id}, submitted=time.monotonic())
+        self._jobs[job["id"]] = job
+        analysis = FakeObject(id=analysis_id, label=label or gear_name, container_type="analysis",
+                              parents=dict(parent["parents"], **{parent["container_type"]: parent_id}),
+                              gear_info=FakeObject(name=gear_name, version=gear_version),
+                              job=job, files=[], created=datetime.now(), modified=datetime.now())
+        self._containers[analysis_id] = analysis
+        parent["analyses"].append(analysis)
+        parent["modified"] = datetime.now()
+        return analysis_id
+
+    def set_job_state(self, job_id, state):
+        self._jobs[job_id]["state"] = state
+
+    def schedule_jobs(self, run_seconds, state="complete"):
+        """Simulated job backend: pending jobs reach `state` `run_seconds` after they were submitted.
+
+        Call `advance_jobs()` (done automatically on every job query) to apply due transitions.
+        """
+        self._job_runtime = (run_seconds, state)
+
+    def advance_jobs(self):
+        if not self._job_runtime:
+            return
+        run_seconds, state = self._job_runtime
+        now = time.monotonic()
+        for job in self._jobs.values():
+            if job["state"] in ("pending", "running") and now - job["submitted"] >= run_seconds:
+                job["state"] = state
+
+    # ------------------------------- #
+    # ----------- sdk api ----------- #
+    # ------------------------------- #
+
+    def get_container(self, cid):
+        self._api_call("get_container")
+        return self._snapshot(self._containers[cid])
+
+    def get(self, cid):
+        return self.get_container(cid)
+
+    def get_project(self, pid):
+        self._api_call("get_project")
+        return self._snapshot(self._containers[pid])
+
+    def get_subject(self, sid):
+        self._api_call("get_subject")
+        return self._snapshot(self._containers[sid])
+
+    def get_session(self, sid):
+        self._api_call("get_session")
+        return self._snapshot(self._containers[sid])
+
+    def get_acquisition(self, aid):
+        self._api_call("get_acquisition")
+        return self._snapshot(self._containers[aid])
+
+    def get_analysis(self, aid):
+        self._api_call("get_analysis")
+        return self._snapshot(self._containers[aid])
+
+    def get_job(self, jid):
+        self._api_call("get_job")
+        self.advance_jobs()
+        return FakeObject(self._jobs[jid])
+
+    def search(self, query, size=100):
+        # only `project._id = "<id>" AND (file.name CONTAINS "<text>" OR ...)` queries on acquisition files
+        self._api_call("search")
+        if not self.search_enabled:
+            raise AttributeError("search")
+        text = query["structured_query"]
+        project_id = re.search(r'project\._id = "([^"]+)"', text).group(1)
+        literals = re.findall(r'file\.name CONTAINS "([^"]+)"', text)
+        results = []
+        for acq in self._containers.values():
+            if acq["container_type"] != "acquisition" or acq["parents"].get("project") != project_id:
+                continue
+            session = self._containers[acq["parents"]["session"]]
+            for fl in acq["files"]:
+                if any(literal in fl["name"] for literal in literals):
+                    results.append(FakeObject(file=FakeObject(name=fl["name"]),
+                                              parent=FakeObject(id=acq["id"], type="acquisition"),
+                                              session=FakeObject(label=session["label"]),
+                                              subject=FakeObject(code=session["subject"]["label"])))
+        return results[:size]
+
+    def lookup(self, path):
+        self._api_call("lookup")
+        if path.startswith("gears/"):
+            return self._gears[path[len("gears/"):]]
+        raise KeyError(path)
+
+
+def make_fake_site(n_sessions, template, n_acquisitions=3, latency=0.0, project_files=()):
+    """Builds a FakeClient with one project holding `n_sessions` sessions.
+
+    The gears template is stored as a project file and every gear named in
+    the template is registered, so `gears.run_auto_gear` runs end-to-end.
+
+    Args:
+        n_sessions (int): number of sessions to create.
+        template (dict): gears template (same layout as gears_template_example.json).
+        n_acquisitions (int): acquisitions per session.
+        latency (float): seconds slept for every simulated API round-trip.
+        project_files (list): additional project file names.
+
+    Returns:
+        tuple: (FakeClient, list of session ids)
+    """
+    fw = FakeClient(latency=latency)
+    files = [("gears_template_JSON.txt", json.dumps(template).encode("utf-8"))]
+    files += [(name, b"") for name in project_files]
+    pid = fw.add_project("benchmark", files=files)
+
+    for step in template["analysis"]:
+        fw.add_gear(step["gear-name"], step.get("gear-version", "0.0.1"))
+
+    session_ids = []
+    for i in range(n_sessions):
+        subject_id = fw.add_subject(pid, "%03d" % i)
+        sid = fw.add_session(subject_id, "ses-01", info={"COMPLETENESS": {"Run Downstream Analyses": True}})
+        for a in range(n_acquisitions):
+            fw.add_acquisition(sid, "acq-%d" % a, files=["acq-%d.nii.gz" % a])
+        session_ids.append(sid)
+
+    return fw, session_ids
@@ -1,7 +1,6 @@
 from pathlib import Path
 import subprocess as sp
 import sys, os, logging
-import flywheel
 from datetime import datetime, date
 import glob
 import pandas as pd
@@ -10,8 +9,17 @@ import time
 import re
 import tempfile
 from zipfile import ZipFile
+import fnmatch
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from _helper_functions.client import get_client
+from _helper_functions.file_discovery import searchfiles  # noqa: F401, re-exported for existing callers
+from _helper_functions.downloads import DownloadManager, fetch_file
+from _helper_functions.uploads import UploadPipeline
 
-fw = flywheel.Client('')
+fw = get_client()
 log = logging.getLogger(__name__)
 
 
@@ -23,99 +31,218 @@ def hasacquisition(session,acq_name):
     return False
 
 
-def searchfiles(path, dryrun=False, find_first=False):
-    cmd = "ls -d " + path
-
-    log.debug("\n %s", cmd)
-
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        files = stdout.strip("\n").split("\n")
-
-        if find_first:
-            files = files[0]
-
-        return files
-    
-    
 os.environ["FLYWHEEL_SDK_REQUEST_TIMEOUT"]="6000"
 
 def upload_file_to_container(conatiner, fp, overwrite=False, update=True, replace_info=[], **kwargs):
     """Upload file to FW container and update info if `update=True`
-    
+
+    Single-file wrapper around uploads.UploadPipeline, use the pipeline directly to
+    upload many files (it uploads concurrently and confirms each container once).
+
     Args:
         container (flywheel.Project): A Flywheel Container (e.g. project, analysis, acquisition)
         fp (Path-like): Path to file to upload
-        update (bool): If true, update container with key/value passed as kwargs.        
-        kwargs (dict): Any key/value properties of Acquisition you would like to update.        
+        overwrite (bool): If true, replace a file of the same name.
+        update (bool): If true, update container with key/value passed as kwargs.
+        replace_info (dict): info to set on the uploaded file.
+        kwargs (dict): Any key/value properties of Acquisition you would like to update.
+
+    Returns:
+        dict: upload result (status, bytes, latency).
     """
-    basename = os.path.basename(fp)
-    if not os.path.isfile(fp):
-        raise ValueError(f'{fp} is not file.')
-        
-    if conatiner.get_file(basename) and not overwrite:
-        log.info(f'File {basename} already exists in container. Skipping.')
-        return
-    
-    if conatiner.get_file(basename) and overwrite:
-        log.info(f'File {basename} already exists, overwriting.')
-        fw.delete_container_file(conatiner.id,basename)
-        time.sleep(10)
-        
-    log.info(f'Uploading {fp} to container {conatiner.id}')
-    conatiner.upload_file(fp)
-    while not conatiner.get_file(basename):   # to make sure the file is available before performing an update
-        conatiner = conatiner.reload()
-        time.sleep(1)
-    
-    f = conatiner.get_file(basename)
-    
-    if replace_info:
-        f.replace_info(replace_info)
-        log.info(f'Replacing info {info.keys()} to acquisition {acquistion.id}')
-        
-    if update and kwargs:
-        f.update(**kwargs)
+    pipeline = UploadPipeline(max_workers=1, max_containers=1, client=fw)
+    pipeline.add(conatiner, fp, overwrite=overwrite, update=update, replace_info=replace_info, **kwargs)
+    result = pipeline.run()[0]
+    if result["error"]:
+        raise result["error"]
+    if conatiner.id in pipeline.errors:
+        raise pipeline.errors[conatiner.id]
+    return result
 
 
-def download_session_analyses_byid(analysis_id, download_path):
-    # loop through all sessions in the project. More detailed filters could be 
-    #   used to specify a subset of sessions
-        
+def download_session_analyses_byid(analysis_id, download_path, manager=None, max_workers=4, include=None, exclude=None):
+    """Downloads (and unzips) all files of an analysis.
+
+    Args:
+        analysis_id (str): flywheel analysis id.
+        download_path (str): destination directory.
+        manager (DownloadManager): if given, the files are queued on this manager and the
+            function returns without waiting, so several analyses download concurrently.
+            With a manifest on the manager, files and archives completed by an earlier run are skipped.
+        max_workers (int): parallel file downloads when no manager is given.
+        include (list): only download files / zip members matching these globs or regexes
+            (e.g. "*_desc-confounds_timeseries.tsv", see member_matcher).
+        exclude (list): skip files / zip members matching these globs or regexes.
+
+    With a download cache (see downloads.use_cache), files are linked from the cache:
+    hardlinks are read-only and symlinks dangle once the cache evicts the file, unless
+    the cache places copies (FW_DOWNLOAD_CACHE_COPY=1).
+
+    Returns:
+        list: futures of the queued file downloads.
+    """
     analysis = fw.get_container(analysis_id)
 
     full_session = fw.get_container(analysis["parents"]["session"])
 
-    if analysis:
-        for fl in analysis.files:
-            if '.zip' in fl['name']:
-                download_and_unzip_inputs(analysis, fl, download_path)
-            else:
-                os.makedirs(os.path.join(download_path,'files'), exist_ok=True)
-                fl.download(os.path.join(download_path,'files',fl['name']))
+    if not analysis:
+        log.info('Analysis not found: for Subject: %s Session: %s', full_session.subject.label, full_session.label)
+        return []
 
-        log.info('Downloaded analysis: %s for Subject: %s Session: %s', analysis.label,full_session.subject.label, full_session.label)      
+    own_manager = manager is None
+    manager = manager or DownloadManager(max_workers=max_workers)
+    selected = member_matcher(include, exclude)
+    futures = []
+    for fl in analysis.files:
+        if '.zip' in fl['name']:
+            futures.append(manager.submit_file(fl, analysis.id+'/'+fl['name'], download_and_unzip_inputs, analysis, fl, download_path,
+                                               stats=manager.stats, include=include, exclude=exclude))
+        elif selected(fl['name']):
+            futures.append(manager.download(fl, os.path.join(download_path,'files',fl['name'])))
+
+    if own_manager:
+        manager.close()
+        log.info('Downloaded analysis: %s for Subject: %s Session: %s', analysis.label,full_session.subject.label, full_session.label)
     else:
-        log.info('Analysis not found: for Subject: %s Session: %s', full_session.subject.label, full_session.label)  
+        log.info('Queued analysis: %s for Subject: %s Session: %s (%s files)', analysis.label,full_session.subject.label, full_session.label, len(futures))
+    return futures
 
 
         
-def download_and_unzip_inputs(parent_obj, file_obj, path):
+# below this fraction of the archive size, selected zip members are downloaded individually
+MEMBER_DOWNLOAD_FRACTION = 0.5
+
+
+def member_matcher(include=None, exclude=None):
+    """Returns a function telling whether a zip member path is selected.
+
+    Patterns are globs matched against the member path (e.g. "*_desc-confounds_timeseries.tsv"),
+    or compiled regexes searched in it. No `include` selects every member.
+    """
+    def matches(path, patterns):
+        for pattern in patterns:
+            if isinstance(pattern, re.Pattern):
+                if pattern.search(path):
+                    return True
+            elif fnmatch.fnmatch(path, pattern):
+                return True
+        return False
+
+    include = [include] if isinstance(include, (str, re.Pattern)) else list(include or [])
+    exclude = [exclude] if isinstance(exclude, (str, re.Pattern)) else list(exclude or [])
+    return lambda path: (not include or matches(path, include)) and not matches(path, exclude)
+
+
+def _member_target(dest, name, strip_prefix):
+    # final path of a zip member, None for the stripped top dir itself; rejects paths leaving dest
+    if strip_prefix:
+        if not name.startswith(strip_prefix + "/"):
+            return None
+        name = name[len(strip_prefix) + 1:]
+    if not name.strip("/"):
+        return None
+    target = os.path.normpath(os.path.join(dest, name))
+    if os.path.isabs(name) or not target.startswith(os.path.normpath(dest) + os.sep):
+        raise ValueError(f"zip member {name} would be extracted outside of {dest}")
+    return target
+
+
+def extract_zip(zip_path, dest, strip_prefix=None, members=None, max_workers=4):
+    """Extracts a zip archive in-process, straight to its final location.
+
+    Args:
+        zip_path (str): zip file.
+        dest (str): destination directory.
+        strip_prefix (str): top directory removed from member paths (e.g. the analysis id).
+        members (callable or list): member paths to extract, or a function selecting them
+            (see member_matcher); all members if None.
+        max_workers (int): members extracted in parallel.
+
+    Returns:
+        int: number of files and links extracted.
+    """
+    with ZipFile(zip_path) as zf:
+        infos = zf.infolist()
+    if callable(members):
+        infos = [i for i in infos if i.is_dir() or members(i.filename)]
+    elif members is not None:
+        wanted = set(members)
+        infos = [i for i in infos if i.filename in wanted]
+
+    files, links = [], []
+    for info in infos:
+        target = _member_target(dest, info.filename, strip_prefix)
+        if target is None:
+            continue
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+        elif stat.S_ISLNK(info.external_attr >> 16):
+            links.append((info, target))
+        else:
+            files.append((info, target))
+
+    # one zip handle per worker thread
+    local = threading.local()
+    handles = []
+
+    def extract(item):
+        info, target = item
+        if not hasattr(local, "zf"):
+            local.zf = ZipFile(zip_path)
+            handles.append(local.zf)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # written next to the target and moved over it: an earlier extraction may have left it read-only
+        tmp = "%s.%s.tmp" % (target, threading.get_ident())
+        try:
+            with local.zf.open(info) as src, open(tmp, "wb") as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(tmp, mode)
+            os.replace(tmp, target)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            list(pool.map(extract, files))
+    finally:
+        for handle in handles:
+            handle.close()
+
+    # symbolic links store their target as member content
+    with ZipFile(zip_path) as zf:
+        for info, target in links:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(zf.read(info).decode("utf-8"), target)
+
+    return len(files) + len(links)
+
+
+def download_and_unzip_inputs(parent_obj, file_obj, path, stats=None, include=None, exclude=None, max_workers=4):
     """
     unzip_inputs unzips the contents of zipped gear output into the working
     directory.
+    
+    Archives with the analysis id as top directory are extracted directly into
+    `path` with that directory stripped, other zips go into `path`/files.
+    Members are extracted in-process (symbolic links preserved), the
+    downloaded zip is removed afterwards.
     Args:
-        zip_filename (string): The file to be unzipped
+        parent_obj (flywheel.Analysis): container holding the zip file
+        file_obj (flywheel.FileEntry): The file to be unzipped
+        path (string): destination directory
+        stats (DownloadStats): download counters to update
+        include (list): only extract members matching these globs / regexes (see member_matcher)
+        exclude (list): skip members matching these globs / regexes
+        max_workers (int): members extracted (or downloaded) in parallel
+
+    With `include` / `exclude`, members adding up to less than MEMBER_DOWNLOAD_FRACTION
+    of the archive are downloaded one by one instead of fetching the whole zip.
     """
-    rc = 0
-    outpath = []
-    
     os.makedirs(path, exist_ok=True)
     
     # start by checking if zipped file
@@ -125,42 +252,78 @@ def download_and_unzip_inputs(parent_obj, file_obj, path):
     # next check if the zip file is organized with analysis id as top dir
     zip_info = parent_obj.get_file_zip_info(file_obj.name)
     zip_top_dir = zip_info.members[0].path.split('/')[0]
-    if len(zip_top_dir)==24:
-        # this is an archive zip and needs to be handled special
-        with tempfile.TemporaryDirectory(dir=path) as tempdir:
-            zipfile = os.path.join(tempdir,file_obj.name)
-
-            # download zip
-            file_obj.download(zipfile)
-
-            # use linux "unzip" methods in shell in case symbolic links exist
-            log.info("Unzipping file, %s", os.path.basename(zipfile))
-            cmd = ["unzip","-qq","-o",zipfile,"-d",tempdir]
-            result = sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
-            log.info("Done unzipping.")
-
-            try:
-                # use subprocess shell command here since there is a wildcard
-                cmd = "mv "+os.path.join(tempdir,zip_top_dir,"*")+" "+path
-                result = sp.run(cmd, shell=True, check=True, stdout=sp.PIPE, stderr=sp.PIPE)
-            except sp.CalledProcessError as e:
-                cmd = "cp -R "+os.path.join(tempdir,zip_top_dir,"*")+" "+path
-                result = sp.run(cmd, shell=True, check=True, stdout=sp.PIPE, stderr=sp.PIPE)
-            finally:
-                cmd = ['rm','-Rf',os.path.join(tempdir,zip_top_dir)]
-                run_command_with_retry(cmd, delay=5)
-    else:
+    strip_prefix = zip_top_dir if len(zip_top_dir)==24 else None
+    if not strip_prefix:
         path = os.path.join(path,"files")
         os.makedirs(path, exist_ok=True)
-        zipfile = os.path.join(path,file_obj.name)
+
+    # select members from the zip listing, before anything is downloaded
+    members = None
+    if include or exclude:
+        selected = member_matcher(include, exclude)
+        members = [m for m in zip_info.members if not m.path.endswith("/") and selected(m.path)]
+        log.info("Selected %s of %s members in %s", len(members), len(zip_info.members), file_obj.name)
+        if not members:
+            return
+
+        # only a small part of the archive: fetch the members one by one
+        selected_size = sum(getattr(m, "size", None) or 0 for m in members)
+        if getattr(file_obj, "size", None) and selected_size < MEMBER_DOWNLOAD_FRACTION * file_obj.size:
+            download_zip_members(parent_obj, file_obj, members, path, strip_prefix, stats=stats, max_workers=max_workers)
+            return
+
+    with tempfile.TemporaryDirectory(dir=path) as tempdir:
+        zipfile = os.path.join(tempdir,file_obj.name)
+
         # download zip
-        file_obj.download(zipfile)
-        # use linux "unzip" methods in shell in case symbolic links exist
+        fetch_file(file_obj, zipfile, stats)
+
         log.info("Unzipping file, %s", os.path.basename(zipfile))
-        cmd = ["unzip","-qq","-o",zipfile,"-d",path]
-        result = sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
-        log.info("Done unzipping.")
-        os.remove(zipfile)
+        n = extract_zip(zipfile, path, strip_prefix=strip_prefix,
+                        members=[m.path for m in members] if members is not None else None, max_workers=max_workers)
+        log.info("Done unzipping (%s members).", n)
+
+
+def download_zip_members(parent_obj, file_obj, members, path, strip_prefix=None, stats=None, max_workers=4):
+    """Downloads selected members of a zip file without fetching the archive.
+
+    Args:
+        parent_obj (flywheel.Analysis): container holding the zip file
+        file_obj (flywheel.FileEntry): the zip file
+        members (list): zip members (entries of `get_file_zip_info(...).members`)
+        path (string): destination directory
+        strip_prefix (str): top directory removed from member paths (e.g. the analysis id)
+        stats (DownloadStats): download counters to update
+        max_workers (int): members downloaded in parallel
+
+    Returns:
+        int: number of members downloaded (members already present with the same size are skipped).
+    """
+    def download(member):
+        target = _member_target(path, member.path, strip_prefix)
+        if target is None:
+            return 0
+        if getattr(member, "size", None) is not None and os.path.isfile(target) and os.path.getsize(target) == member.size:
+            if stats:
+                stats.add_file(skipped=True)
+            return 0
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = "%s.%s.tmp" % (target, threading.get_ident())
+        try:
+            parent_obj.download_file_zip_member(file_obj.name, member.path, tmp)
+            os.replace(tmp, target)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        if stats:
+            stats.add_bytes(os.path.getsize(target))
+            stats.add_file()
+        return 1
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        n = sum(pool.map(download, members))
+    log.info("Downloaded %s members of %s", n, file_obj.name)
+    return n
         
 
 def run_command_with_retry(cmd, retries=3, delay=1, cwd=os.getcwd()):
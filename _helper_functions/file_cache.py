@@ -0,0 +1,221 @@
+"""
+Content-addressed local cache for downloaded flywheel files.
+
+Files are stored once under the cache root, keyed by flywheel file id,
+version and hash, and linked into each destination: a hardlink if the
+destination is on the same filesystem, a symlink otherwise. The least
+recently used files are evicted once the cache grows past its size cap.
+
+Cached files are made read-only, so a pipeline modifying a downloaded file
+in place cannot corrupt the cache. Two effects follow for the destinations:
+
+    - hardlinked destinations share the object, so they are read-only too;
+    - symlinked destinations dangle once their object is evicted (a warning
+      is logged when that happens).
+
+Create the cache with `copy=True` (FW_DOWNLOAD_CACHE_COPY=1) to place
+writable, independent copies in the destinations instead.
+
+Enable it for every download made through `downloads.fetch_file` with
+
+    export FW_DOWNLOAD_CACHE=/pl/active/<lab>/fw-cache
+    export FW_DOWNLOAD_CACHE_GB=500
+    export FW_DOWNLOAD_CACHE_COPY=1     # optional, writable copies instead of links
+
+or in code with `downloads.use_cache(FileCache(root, max_bytes))`.
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+
+from _helper_functions.manifest import parse_hash, file_digest
+
+log = logging.getLogger(__name__)
+
+
+def file_key(file_entry):
+    """Returns the cache key of a flywheel file, None if it cannot be identified."""
+    file_id = getattr(file_entry, "file_id", None) or getattr(file_entry, "id", None)
+    if not file_id:
+        return None
+    return "%s:%s:%s" % (file_id, getattr(file_entry, "version", None), getattr(file_entry, "hash", None))
+
+
+class FileCache:
+    """Local download cache with LRU eviction.
+
+    Args:
+        root (str): cache directory (holds `objects/` and the `index.db` sqlite index).
+        max_bytes (int): size cap, least recently used files are evicted beyond it.
+        symlink (bool): always symlink into destinations instead of trying a hardlink first.
+        copy (bool): copy files into destinations (writable, unaffected by eviction) instead of linking.
+    """
+
+    def __init__(self, root, max_bytes=100 * 1024 ** 3, symlink=False, copy=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.symlink = symlink
+        self.copy = copy
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evicted = 0
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._key_locks = defaultdict(threading.Lock)
+        # the cache can be shared by several batch jobs: wait for their writes instead of failing
+        self._db = sqlite3.connect(os.path.join(root, "index.db"), timeout=60, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                path TEXT,
+                size INTEGER,
+                last_access REAL,
+                hits INTEGER
+            )""")
+        # symlinked destinations, to report the ones left dangling by eviction
+        self._db.execute("CREATE TABLE IF NOT EXISTS links (key TEXT, dest TEXT, PRIMARY KEY (key, dest))")
+        self._db.commit()
+
+    def _object_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _lookup(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT path, size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row and os.path.isfile(row[0]):
+            return row
+        return None
+
+    def _link(self, key, path, dest):
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if self.copy:
+            shutil.copyfile(path, dest)
+            return
+        if not self.symlink:
+            try:
+                os.link(path, dest)
+                return
+            except OSError:
+                pass    # other filesystem (or no hardlink support)
+        os.symlink(os.path.abspath(path), dest)
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO links VALUES (?, ?)", (key, os.path.abspath(dest)))
+            self._db.commit()
+
+    def _dangling(self, key, path):
+        # symlinked destinations still pointing to an object about to be removed (call with _lock held)
+        dests = [row[0] for row in self._db.execute("SELECT dest FROM links WHERE key = ?", (key,))]
+        self._db.execute("DELETE FROM links WHERE key = ?", (key,))
+        target = os.path.abspath(path)
+        return [dest for dest in dests if os.path.islink(dest) and os.readlink(dest) == target]
+
+    def fetch(self, file_entry, dest, download):
+        """Places a flywheel file at `dest`, downloading it only on a cache miss.
+
+        Args:
+            file_entry (flywheel.FileEntry): file to fetch.
+            dest (str): destination path.
+            download (callable): download(file_entry, path) -> bytes transferred, used on a miss.
+
+        Returns:
+            int: bytes transferred (0 on a hit).
+        """
+        key = file_key(file_entry)
+        if key is None:
+            return download(file_entry, dest)
+
+        with self._key_locks[key]:
+            row = self._lookup(key)
+            if row:
+                self._link(key, row[0], dest)
+                with self._lock:
+                    self.hits += 1
+                    self.bytes_saved += row[1]
+                    self._db.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                log.debug("cache hit: %s", dest)
+                return 0
+
+            path = self._object_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # unique name per process and thread: other jobs may be fetching the same object
+            tmp = "%s.%s-%s.tmp" % (path, os.getpid(), threading.get_ident())
+            try:
+                received = download(file_entry, tmp)
+                algorithm, digest = parse_hash(getattr(file_entry, "hash", None))
+                if digest is not None and file_digest(tmp, algorithm) != digest:
+                    raise IOError("checksum mismatch for %s, not cached" % file_entry.name)
+                os.chmod(tmp, 0o444)
+                os.replace(tmp, path)
+            finally:
+                for leftover in (tmp, tmp + ".part"):
+                    if os.path.isfile(leftover):
+                        os.remove(leftover)
+            size = os.path.getsize(path)
+            with self._lock:
+                self.misses += 1
+                self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, 0)", (key, path, size, time.time()))
+                self._db.commit()
+            self._link(key, path, dest)
+            self.evict(keep=key)
+            return received
+
+    def discard(self, file_entry):
+        """Removes a file from the cache (e.g. after its linked copy failed verification)."""
+        key = file_key(file_entry)
+        if key is None:
+            return
+        with self._key_locks[key], self._lock:
+            row = self._db.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._db.execute("DELETE FROM links WHERE key = ?", (key,))
+            self._db.commit()
+        if row and os.path.isfile(row[0]):
+            os.remove(row[0])
+
+    def evict(self, keep=None):
+        """Removes least recently used files until the cache fits its size cap."""
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, path, size in self._db.execute(
+                    "SELECT key, path, size FROM entries ORDER BY last_access").fetchall():
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                # hardlinked destinations keep their copy, symlinked ones become dangling
+                dangling = self._dangling(key, path)
+                if dangling:
+                    log.warning("Evicting %s from the download cache leaves %s symlinked destinations dangling: %s",
+                                path, len(dangling), ", ".join(dangling[:5]) + (", ..." if len(dangling) > 5 else ""))
+                if os.path.isfile(path):
+                    os.remove(path)
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                self.evicted += 1
+            self._db.commit()
+
+    def report(self):
+        """Returns cache statistics: hits, misses, hit rate, bytes saved, entries and size."""
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "MB_saved": round(self.bytes_saved / 1e6, 1), "evicted": self.evicted,
+                "entries": entries, "MB": round(size / 1e6, 1), "MB_max": round(self.max_bytes / 1e6, 1)}
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,164 @@
+"""
+Find acquisition files of a project by file name pattern.
+
+Patterns are resolved server-side with one flywheel search query when they
+can be: the literal part of every pattern is pushed into a
+`file.name CONTAINS` filter, and the regexes are then applied to the (few)
+results. When a pattern has no literal part, or the search endpoint is
+unavailable, the project is walked once instead, with session acquisition
+lists fetched concurrently and every file name tested against all patterns
+through a PatternIndex.
+
+Either way matches are yielded as they are found, so they can be fed straight
+into a DownloadManager:
+
+    with DownloadManager(max_workers=8) as manager:
+        for match in find_files(project, ["recording", r"_events\\.tsv$"]):
+            manager.download(match.file, os.path.join(path, match.file.name))
+"""
+
+import re
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import flywheel
+
+from _helper_functions.client import get_client
+
+fw = get_client()
+log = logging.getLogger(__name__)
+
+SEARCH_SIZE = 10000
+
+FileMatch = namedtuple("FileMatch", ["pattern", "file", "subject_label", "session_label", "acquisition_id"])
+
+# characters that make a pattern more than a plain (escaped) string
+_REGEX_SYNTAX = re.compile(r"(?<!\\)[.^$*+?{}\[\]|()]|\\[A-Za-z0-9]")
+
+
+def search_literal(pattern):
+    """Returns the text every match of `pattern` contains, None if it is not a plain string.
+
+    Anchors and escaped characters are allowed (`^sub-01_T1w\\.nii` -> `sub-01_T1w.nii`).
+    """
+    text = pattern[1:] if pattern.startswith("^") else pattern
+    text = text[:-1] if text.endswith("$") and not text.endswith("\\$") else text
+    if not text or _REGEX_SYNTAX.search(text):
+        return None
+    return re.sub(r"\\(.)", r"\1", text)
+
+
+class PatternIndex:
+    """Several file name patterns tested together.
+
+    Names are first checked against one combined regex, so a name that matches
+    none of the patterns costs a single search.
+
+    Args:
+        patterns (list): regex strings (or compiled patterns).
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [p if isinstance(p, re.Pattern) else re.compile(p) for p in patterns]
+        self._any = re.compile("|".join("(?:%s)" % p.pattern for p in self.patterns))
+
+    def match(self, name):
+        """Returns the pattern strings `name` matches (in pattern order)."""
+        if not self._any.search(name):
+            return []
+        return [p.pattern for p in self.patterns if p.search(name)]
+
+
+def _search_query(project, literals):
+    names = " OR ".join('file.name CONTAINS "%s"' % literal.replace('"', '\\"') for literal in sorted(set(literals)))
+    return 'project._id = "%s" AND (%s)' % (project.id, names)
+
+
+def search_files(project, patterns):
+    """Runs one search query for `patterns`; returns a generator of the FileMatches.
+
+    The query runs (and fails) right away, only resolving the results into
+    downloadable files is deferred to the generator.
+
+    Raises:
+        ValueError: if a pattern cannot be pushed into the query or the result was truncated.
+        flywheel.rest.ApiException: if the search request fails.
+    """
+    index = PatternIndex(patterns)
+    literals = [search_literal(p.pattern) for p in index.patterns]
+    if None in literals:
+        raise ValueError("pattern without a literal part")
+
+    results = fw.search({"structured_query": _search_query(project, literals), "return_type": "file"}, size=SEARCH_SIZE)
+    if len(results) >= SEARCH_SIZE:
+        raise ValueError("search result truncated at %s files" % SEARCH_SIZE)
+    return _resolve_search(results, index)
+
+
+def _resolve_search(results, index):
+    acquisitions = {}
+    for result in results:
+        if result.parent.type != "acquisition":
+            continue
+        for pattern in index.match(result.file.name):
+            # search results do not carry a downloadable file, fetch each acquisition once
+            if result.parent.id not in acquisitions:
+                acquisitions[result.parent.id] = fw.get_acquisition(result.parent.id)
+            fl = acquisitions[result.parent.id].get_file(result.file.name)
+            subject_label = getattr(result.subject, "code", None) or getattr(result.subject, "label", None)
+            yield FileMatch(pattern, fl, subject_label, result.session.label, result.parent.id)
+
+
+def walk_files(project, patterns, max_workers=8):
+    """Yields FileMatches found by walking the project's acquisitions once.
+
+    Args:
+        project (flywheel.Project): project container.
+        patterns (list): regex strings.
+        max_workers (int): number of session acquisition lists fetched at the same time.
+    """
+    index = PatternIndex(patterns)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        # session futures map to their session, acquisition futures to (session, matches)
+        pending = {pool.submit(ses.acquisitions): ses for ses in project.sessions.find()}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                owner = pending.pop(future)
+                if isinstance(owner, tuple):
+                    ses, matches = owner
+                    full_acq = future.result()
+                    for pattern, name in matches:
+                        yield FileMatch(pattern, full_acq.get_file(name), ses.subject.label, ses.label, full_acq.id)
+                    continue
+                for acq in future.result():
+                    matches = [(pattern, fl.name) for fl in acq.files for pattern in index.match(fl.name)]
+                    if matches:
+                        # listed files cannot be downloaded, fetch the acquisitions holding a match
+                        pending[pool.submit(fw.get_acquisition, acq.id)] = (owner, matches)
+
+
+def find_files(project, patterns, use_search=True, max_workers=8):
+    """Yields the acquisition files of a project matching any of `patterns`.
+
+    Args:
+        project (flywheel.Project): project container.
+        patterns (str or list): regex string(s) searched in the file names.
+        use_search (bool): try a server-side search before walking the project.
+        max_workers (int): number of concurrent requests when walking.
+
+    Yields:
+        FileMatch: (pattern, file, subject_label, session_label, acquisition_id), once per matching pattern.
+    """
+    if isinstance(patterns, (str, re.Pattern)):
+        patterns = [patterns]
+    if use_search:
+        try:
+            matches = search_files(project, patterns)
+        except (ValueError, AttributeError, flywheel.rest.ApiException) as e:
+            log.info("Search not usable (%s), walking the project instead", e)
+        else:
+            yield from matches
+            return
+    yield from walk_files(project, patterns, max_workers=max_workers)
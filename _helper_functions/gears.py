@@ -3,18 +3,40 @@ import sys, subprocess, os, logging
 import flywheel
 import glob
 import pandas as pd
-from time import sleep
-import re
 import tempfile
 import json
 from dateutil.tz import tzutc
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed, FIRST_COMPLETED, Future
+from _helper_functions.cache import ContainerCache
+from _helper_functions.analysis_index import AnalysisIndex
+from _helper_functions.templates import CompiledTemplate, compile_inputs, input_pattern, step_gear_name
+from _helper_functions.jobs import JobWatcher, TERMINAL_STATES
+from _helper_functions.submission import SubmissionQueue
+from _helper_functions import profiling
+from _helper_functions.client import get_client, is_instrumented
 
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger('main')
 
-fw = flywheel.Client('')
+fw = get_client()
+
+# containers and gears shared by all sessions in a sweep (see reset_cache)
+cache = ContainerCache(fw)
+
+
+def reset_cache(ttl=300, client=None):
+    """Starts a new request-scoped container cache.
+
+    Args:
+        ttl (float): seconds an entry stays valid.
+        client (flywheel.Client): client the sweep's calls go through (default: the module client).
+    """
+    global cache
+    cache = ContainerCache(client or fw, ttl=ttl)
+    return cache
+
 
 ## Helper Function for getting date
 def get_x_days_ago(x, date=None):
@@ -50,76 +72,83 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
         return gear_job_id
     except flywheel.rest.ApiException:
         log.exception('An exception was raised when attempting to submit a job for %s',
-                      gear_job_id.name)
+                      gear['gear']['name'])
         
         
-def generate_inputs(session, template):
-    
-    # if analysis should run - generate all inputs then run...
-    if "inputs" in template:
-        # initalize my inputs as dictionary
-        myinputs = dict()
-        
-        # loop through all inputs in template
-        for key in template["inputs"]:
+def _container_files(container, shared):
+    # name -> file entry; listings of shared parent containers (project, subject) are cached for the sweep
+    if not shared:
+        return {file['name']: file for file in container.files}
+    return cache.get("files", container.id, lambda: {file['name']: file for file in container.files})
 
-            # put input files in the format flywheel gear.run expects...
-            if "parent-container" in template["inputs"][key]:
-                if template["inputs"][key]["parent-container"] == "session":
-                    fw_container = session
-                else:
-                    fw_container = fw.get_container(session.parents[template["inputs"][key]["parent-container"]])
-            elif "find-analysis" in template["inputs"][key]:
-                fw_container = find_analysis(session, template["inputs"][key]["find-analysis"],status=["complete"])
-            elif "find-analysis-label" in template["inputs"][key]:
-                gear_info = template["inputs"][key]["find-analysis-label"].split(":")[0]
-                label = template["inputs"][key]["find-analysis-label"].split(":")[1]
-                fw_container = find_analysis(session, gear_info,status=["complete"], analysis_label=label)
-            else:
-                log.error("Unable to interpret inputs: Project %s Subject %s Session %s %s ", project.label, full_session.subject.label, full_session.label, full_session.id)
-            
-            # Add option to insert Flywheel labels into searchable file names ** allows for different inputs based on subject name or session name
-            lookup_table = {
-                "SUBJECT": session.subject.label,
-                "SESSION": session.label,
-            }
-            # if 'value' key is passed for an input, just get the file from flywheel using given name"
-            if "value" in template["inputs"][key]:
-                filename_from_lookup = apply_lookup(template["inputs"][key]["value"],lookup_table)
-                file_found = fw_container.get_file(filename_from_lookup)
-                if "optional" in template["inputs"][key] and template["inputs"][key]["optional"] == True and not file_found:
-                        pass
-                else:
-                    myinputs[key]=file_found
-
-            # if 'regex' key is passed from an input, look for files matching the regular expression, save file if a match is found
-            elif "regex" in template["inputs"][key]:
-
-                namelist = [file['name'] for file in fw_container.files]
-                
-                filename_from_lookup = apply_lookup(template["inputs"][key]["regex"], lookup_table)
-                r1=re.compile(filename_from_lookup)
-                matching_names = [x for x in namelist if r1.search(x)]
-
-                if len(matching_names) == 1:
-                    myinputs[key]=fw_container.get_file(matching_names[0])
-                    log.debug("files found for analysis: %s"," ,".join(matching_names))
-
-                elif len(matching_names) > 1:
-                    log.debug("files found for analysis: %s"," ,".join(matching_names))
-                    log.error("not sure which file to use, multiple matches...skipping")
-                    run_flag = False 
-
-                elif len(matching_names) < 1:
-                    # check if input was optionl, if so, ok that is wasn't found, proceed
-                    if "optional" in template["inputs"][key] and template["inputs"][key]["optional"] == True:
-                        pass
-                    else:
-                        log.error("unable to locate required file input...skipping")
-                        run_flag = False 
-    else:
-        myinputs = None
-    
+
+def _input_container(session, spec):
+    # container holding the input file, and whether it is shared between sessions
+    if spec.source == "parent-container":
+        if spec.source_value == "session":
+            return session, False
+        return cache.get_container(session.parents[spec.source_value]), True
+    if spec.source == "find-analysis":
+        return find_analysis(session, spec.source_value, status=["complete"]), False
+    gear_info, label = spec.source_value.split(":")[0:2]
+    return find_analysis(session, gear_info, status=["complete"], analysis_label=label), False
+
+
+def resolve_inputs(session, specs):
+    """Finds the input files for one template step in a full session.
+
+    Args:
+        session (flywheel.Session): full session object.
+        specs (list): InputSpec entries from templates.compile_inputs (None if the step takes no inputs).
+
+    Returns:
+        tuple: (inputs dict in the format gear.run expects or None, list of errors). The step
+            should not run if any errors are returned.
+    """
+    if specs is None:
+        return None, []
+
+    myinputs = dict()
+    errors = []
+    for spec in specs:
+        if not spec.match:
+            continue
+        fw_container, shared = _input_container(session, spec)
+        if not fw_container:
+            if not spec.optional:
+                errors.append("input %s: no matching analysis for %s" % (spec.key, spec.source_value))
+            continue
+        files = _container_files(fw_container, shared)
+        pattern = input_pattern(spec, session)
+
+        # if 'value' key is passed for an input, just get the file from flywheel using given name
+        if spec.match == "value":
+            matching_names = [pattern] if pattern in files else []
+        # if 'regex' key is passed from an input, look for files matching the regular expression
+        elif shared:
+            matching_names = cache.get("input_match", (fw_container.id, pattern.pattern),
+                                       lambda: [x for x in files if pattern.search(x)])
+        else:
+            matching_names = [x for x in files if pattern.search(x)]
+
+        if len(matching_names) == 1:
+            myinputs[spec.key] = files[matching_names[0]]
+            log.debug("files found for analysis: %s"," ,".join(matching_names))
+        elif len(matching_names) > 1:
+            log.debug("files found for analysis: %s"," ,".join(matching_names))
+            log.error("not sure which file to use, multiple matches...skipping")
+            errors.append("input %s: multiple matching files" % spec.key)
+        elif not spec.optional:
+            # check if input was optional, if so, ok that is wasn't found, proceed
+            log.error("unable to locate required file input...skipping")
+            errors.append("input %s: required file not found" % spec.key)
+
+    return myinputs, errors
+
+
+def generate_inputs(session, template):
+    # inputs for a single template step, in the format flywheel gear.run expects
+    myinputs, errors = resolve_inputs(session, compile_inputs(template))
     return myinputs
 
 
@@ -130,57 +159,42 @@ def apply_lookup(text, lookup_table):
     return text
 
 
+def get_analysis_index(container):
+    """Returns the (cached) AnalysisIndex for a full session object.
+
+    The index holds session and acquisition level analyses and is dropped from the
+    cache whenever a job is submitted to the session. Acquisitions are fetched
+    uncached when it is rebuilt, so their analyses are as fresh as the index.
+    """
+    with profiling.phase("analysis lookup"):
+        return cache.get("analysis_index", container.id, lambda: AnalysisIndex.from_session(container, cache.client))
+
+
 def my_analysis_exists(container, gear_info, status=["complete","running","pending"], status_bool_type="any", count_up_to_failures=1, analysis_label=None):
     # Returns True if analysis already exists with a running or complete status, else false
     # make sure to pass full session object (use fw.get_session(session.id))
     #
-    #Get all analyses for the session
+    #Get all analyses for the session (both session and acquisition level analyses, indexed once per session)
     flag=False
     counter=0
     
-    #handle checks for any version of gear or specific version 
-    if "/" in gear_info:
-        gear_name = gear_info.split("/")[0]
-        gear_version = gear_info.split("/")[1]  # allow wildcard expressions here to check for multiple gear versions 
-    else:
-        gear_name = gear_info
-        gear_version = []
-        
-    # pull both session and acquisition level analyses to check... a bit slower but more complete.
-    acq_analyses = [ fw.get_acquisition(a.id).analyses for a in container.acquisitions.find()] # pull analyses from all acquisitions
-    acq_analyses = [item for sublist in acq_analyses for item in sublist] #flatten list of acquisitons
-    ses_analyses = container.analyses
-    all_analyses = ses_analyses+acq_analyses
-    
-    # check all session analyses
-    for analysis in all_analyses:
-        if not analysis.gear_info:
-            continue
-        #only print ones that match the analysis label
-        if gear_name == analysis.gear_info.name:
-            if gear_version:
-                r1 = re.compile(gear_version)
-                if not r1.search(analysis.gear_info["version"]):
-                    continue
-            if analysis_label:
-                if analysis_label not in analysis.label:
-                    continue
-            #filter for only successful job
-            analysis_job=analysis.job
-            if not hasattr(analysis_job,'state'): 
-                flag=True
-            else:
-                if any(analysis_job.state in string for string in status):
-                    if analysis_job.state == "failed":
-                        counter += 1
-                        if counter >= count_up_to_failures:
-                            flag=True
-                    else:
+    # gear_info is either gear name or gear/version... allow wildcard expressions in version to check for multiple gear versions 
+    for record in get_analysis_index(container).find(gear_info, analysis_label=analysis_label):
+        #filter for only successful job
+        if record.state is None: 
+            flag=True
+        else:
+            if any(record.state in string for string in status):
+                if record.state == "failed":
+                    counter += 1
+                    if counter >= count_up_to_failures:
                         flag=True
                 else:
-                    # if any of the analyses that match name and version, but do not match status
-                    if status_bool_type == "all":
-                        return False
+                    flag=True
+            else:
+                # if any of the analyses that match name and version, but do not match status
+                if status_bool_type == "all":
+                    return False
     
     return flag
 
@@ -189,57 +203,39 @@ def find_analysis(container, gear_info, status=["complete","running","pending"],
     # Returns analysis object if exists by analysis name in that container
     # make sure to pass full session object (use fw.get_session(session.id))
     #
-   
-    #handle checks for any version of gear or specific version 
-    if "/" in gear_info:
-        gear_name = gear_info.split("/")[0]
-        gear_version = gear_info.split("/")[1]  # allow wildcard expressions here to check for multiple gear versions 
-    else:
-        gear_name = gear_info
-        gear_version = []
-    
-    #Get all analyses for the session
     analys_obj = None
     
-    # check all session analyses
-    for analysis in container.analyses:
-        
-        if not analysis.gear_info:
-            continue
-            
-        #only print ones that match the analysis label
-        if gear_name == analysis.gear_info.name:
-            if gear_version:
-                r1 = re.compile(gear_version)
-                if not r1.search(analysis.gear_info["version"]):
-                    continue
-                    
-            if analysis_label:
-                if analysis_label not in analysis.label:
-                    continue
-                    
-            analysis_job=analysis.job
-            if not hasattr(analysis_job,'state'): 
-                analys_obj = analysis
-            else:
-                if any(analysis_job.state in string for string in status):
-                    analys_obj = analysis
+    # check all session analyses, last match wins
+    for record in get_analysis_index(container).find(gear_info, analysis_label=analysis_label, level="session"):
+        if record.state is None or any(record.state in string for string in status):
+            analys_obj = record.analysis
     
     return analys_obj
     
     
     
-def my_checks(session, template):
-    
+SKIP_EXISTING = "existing analysis"
+BLOCKED_PREREQUISITES = "prerequisites not met"
+
+
+def check_step(session, template):
+    """Runs all run conditions of one template step against a full session.
+
+    Returns:
+        tuple: (True, None) if the step should run, otherwise (False, reason). The reason is
+            SKIP_EXISTING when the analysis already exists, starts with BLOCKED_PREREQUISITES
+            when a prerequisite analysis is not complete yet, else lists the unmet condition(s).
+    """
     my_gear_name=template["gear-name"]+"/"+template["gear-version"] if "gear-version" in template else template["gear-name"]
     my_gear_label = template["custom-label"] if "custom-label" in template else template["gear-name"]
     numfails = template["count-failures"] if "count-failures" in template else 1
-    run_flag = True
+    project_label = cache.get_project(session.parents["project"]).label
+    reasons = []
     
     # 1. check if analysis already run 
     if my_analysis_exists(session, my_gear_name, status=["complete","running","pending", "failed"], count_up_to_failures=numfails, analysis_label=my_gear_label):
-        log.info("EXISTING analysis found: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
-        return False 
+        log.info("EXISTING analysis found: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, project_label, session.subject.label, session.label,session.id)
+        return False, SKIP_EXISTING
 
     # 2. check if prerequisites are satisfied
     if "prerequisites" in template:
@@ -249,33 +245,36 @@ def my_checks(session, template):
             prereq_type = prereq["prereq-complete-analysis"] if "prereq-complete-analysis" in prereq else "any"
             
             if not my_analysis_exists(session, prereq_gear_name, status=["complete"],status_bool_type=prereq_type, analysis_label=prereq_gear_label):
-                log.info("PREREQUISITES not met: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
-                return False
+                log.info("PREREQUISITES not met: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, project_label, session.subject.label, session.label,session.id)
+                return False, BLOCKED_PREREQUISITES + ": " + (prereq_gear_label or prereq_gear_name)
 
     # 3. check for any completeness or session tags
     if "completeness-tags" in template:
         if "COMPLETENESS" not in session.info:
-            run_flag = False
-            log.info("Completeness conditions not accessible ... Project %s Subject %s Session %s %s ", fw.get_project(session.parents["project"]).label, session.subject.label, session.label, session.id)
+            reasons.append("completeness conditions not accessible")
+            log.info("Completeness conditions not accessible ... Project %s Subject %s Session %s %s ", project_label, session.subject.label, session.label, session.id)
         else:
             for tag in template["completeness-tags"]:
                 if not session.info["COMPLETENESS"][tag]:
-                    run_flag = False
-                    log.info("Completeness condition not satified: %s ... Project %s Subject %s Session %s %s ",tag, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
+                    reasons.append("completeness condition not satisfied: " + tag)
+                    log.info("Completeness condition not satified: %s ... Project %s Subject %s Session %s %s ",tag, project_label, session.subject.label, session.label,session.id)
 
-    if run_flag == False: return False
+    if reasons: return False, "; ".join(reasons)
 
     if "session-tags" in template:
         for tag in template["session-tags"]:
             if tag not in session.tags:
-                run_flag = False
-                log.info("Missing Required session tag: %s ... Project %s Subject %s Session %s %s ",tag, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
+                reasons.append("missing session tag: " + tag)
+                log.info("Missing Required session tag: %s ... Project %s Subject %s Session %s %s ",tag, project_label, session.subject.label, session.label,session.id)
 
-    if run_flag == False: return False
+    if reasons: return False, "; ".join(reasons)
 
     # if you reach this point, all checks passed...
-    return True
+    return True, None
+
 
+def my_checks(session, template):
+    return check_step(session, template)[0]
 
 
 def read_file_to_memory(file):
@@ -289,66 +288,383 @@ def read_file_to_memory(file):
     
     
 def get_container_type(cid):
-    return fw.get_container(cid).container_type
+    return cache.get_container(cid).container_type
+
+
+def _run_template_step(session_id, step, project, input_specs=None, queue=None, dry_run=False):
+    """Runs all checks for one template step and submits the gear if they pass.
+
+    Returns:
+        tuple: (analysis label, id returned by gear.run -- or its Future when a submission
+            queue is passed -- or None if the step was skipped, reason the step was skipped).
+            With dry_run, a step that would be submitted returns (label, None, None).
+    """
+    with profiling.phase("container fetch"):
+        # pull session info at the beggining of each gear call in case changes have occured (refetched after each submission)
+        full_session=cache.get_session(session_id)
 
+        # get gear for analysis (check for optional template entry "gear version" to include in gear descrip)
+        gear = cache.lookup_gear(step_gear_name(step))
 
-def run_auto_gear(session_id, template_file_name = "gears_template_JSON.txt"):
+    # generate analysis label
+    mylabel = step["custom-label"] if "custom-label" in step else gear['gear']['name']
+
+    # ------------------------------- #
+    # ----------- checks ------------ #
+    # ------------------------------- #
+    
+    # 1. check for exisiting analyses...
+    with profiling.phase("checks"):
+        run_flag, reason = check_step(full_session, step)
+    if not run_flag:
+        return mylabel, None, reason
     
+    # ------------------------------- #
+    # ------------ run -------------- #
+    # ------------------------------- #
+                               
+    # pull inputs
+    with profiling.phase("input resolution"):
+        myinputs, errors = resolve_inputs(full_session, input_specs)
+    if errors:
+        return mylabel, None, "; ".join(errors)
+    
+    if dry_run:
+        log.info('WOULD RUN gear: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
+        return mylabel, None, None
+    
+    # label for new analysis....
+    mylabel = mylabel+datetime.now().strftime(" %x %X")
+                                  
+    # pull config
+    myconfig = step["config"]
+
+    # pull tags
+    mytags = step["tags"]
+
+    if queue:
+        run_id = queue.submit(gear, myconfig, myinputs, mytags, full_session, analysis_label=mylabel)
+        log.info('QUEUED gear: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
+    else:
+        run_id = run_gear(gear, myconfig, myinputs, mytags, full_session, analysis_label=mylabel)
+        log.info('RUNNING gear: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
+    
+    return mylabel, run_id, None if run_id else "submission failed"
+
+
+def get_job_id(run_id):
+    # gear.run returns the analysis id for analysis gears and the job id for utility gears
+    try:
+        job = cache.client.get_analysis(run_id).job
+    except flywheel.rest.ApiException:
+        return run_id
+    return job.id if hasattr(job, 'id') else job
+
+
+def run_auto_gear(session_id, template_file_name = "gears_template_JSON.txt", queue=None, dry_run=False):
+    """Applies the gears template stored in the session's project to a single session.
+
+    Template steps are scheduled from their prerequisites: every step whose prerequisite
+    steps are settled is checked (and submitted) in the same pass. Steps that depend on a
+    job submitted during this run wait for that job (see jobs.JobWatcher) for at most its
+    `sleep_seconds`, otherwise they are picked up by the next run.
+
+    Args:
+        session_id (str): flywheel session id.
+        template_file_name (str): name of the gears template (project file).
+        queue (submission.SubmissionQueue): if passed, jobs are queued for submission
+            instead of submitted one at a time.
+        dry_run (bool): run every check and resolve inputs, but do not submit anything.
+
+    Returns:
+        dict: analysis labels "submitted", "planned" (dry run), "skipped" (analysis exists) and
+            "blocked" (run conditions not met) for this session, the blocked steps "waiting" on a
+            prerequisite analysis, a "plan" row (label, decision, reason) per step, the labels of
+            template analyses not finished yet ("unsettled"), plus the session "path", the
+            "template_version", "session_modified" and "analyses_modified" seen at the end of the run.
+    """
+    result = {"path": None, "submitted": [], "planned": [], "skipped": [], "blocked": [], "waiting": [], "plan": [], "unsettled": [],
+              "template_version": None, "session_modified": None, "analyses_modified": None}
+
     # check id passed is a session id, if not abort
-    if get_container_type(session_id) != 'session':
-        log.info("Flywheel Container %s is a %s... not session. Skipping", session_id, get_container_type(session_id))
-        return
+    container_type = get_container_type(session_id)
+    if container_type != 'session':
+        log.info("Flywheel Container %s is a %s... not session. Skipping", session_id, container_type)
+        return result
     
-    full_session=fw.get_session(session_id)
-    project = fw.get_project(full_session["parents"]["project"])
+    # always start from a fresh copy of the session, project and gears can be shared across the sweep
+    cache.invalidate("session", session_id)
+    cache.invalidate("analysis_index", session_id)
+    full_session=cache.get_session(session_id)
+    project = cache.get_project(full_session["parents"]["project"])
+    result["path"] = "%s/%s/%s" % (project.label, full_session.subject.label, full_session.label)
+    log.info("checking workflow: %s", result["path"])
          
     template_file = project.get_file(template_file_name)
     if not template_file:
         log.info(f"{template_file_name} not found within project: {project.label}. Skipping...")
-        return
-    template = read_file_to_memory(template_file)
+        return result
+    result["template_version"] = get_template_version(template_file)
+
+    try:
+        with profiling.phase("template"):
+            compiled = get_compiled_template(project, template_file, result["template_version"])
+    except ValueError as e:
+        log.error("Invalid gears template %s in project %s: %s", template_file_name, project.label, e)
+        return result
+    steps, deps = compiled.steps, compiled.deps
     
     # run each analysis...based on conditions in template
-    for itr, json in enumerate(template["analysis"]):
-        
-        # pull session and project info at the beggining of each gear call in case changes have occured
-        full_session=fw.get_session(session_id)
-
-        # get gear for analysis (check for optional template entry "gear version" to include in gear descrip)
-        my_gear_name = json["gear-name"]+"/"+json["gear-version"] if "gear-version" in json else json["gear-name"]
-        gear = fw.lookup("gears"+"/"+my_gear_name)
-
-        # generate analysis label
-        mylabel = json["custom-label"] if "custom-label" in json else gear['gear']['name']
-
-        # ------------------------------- #
-        # ----------- checks ------------ #
-        # ------------------------------- #
+    waiting = set(range(len(steps)))    # steps not yet checked
+    inflight = {}                       # steps submitted in this run that are still running -> (job id, future)
+    stuck = set()                       # steps blocked by run conditions, directly or through a prerequisite step
+    planned = {}                        # dry run: steps that would be submitted (or wait on one) -> label
+    watcher = JobWatcher(cache.client, min_period=1)
+    while waiting:
+        ready = sorted(i for i in waiting if not deps[i] & (waiting | set(inflight)))
         
-        # 1. check for exisiting analyses...
-        if not my_checks(full_session, json):
+        if not ready:
+            # everything left depends on a job submitted in this run
+            watcher.wait(return_when=FIRST_COMPLETED)
+            for itr, (job_id, future) in list(inflight.items()):
+                if future.done():
+                    watcher.forget(job_id)
+                    del inflight[itr]
+            cache.invalidate("session", session_id)
+            cache.invalidate("analysis_index", session_id)
             continue
         
-        # ------------------------------- #
-        # ------------ run -------------- #
-        # ------------------------------- #
-                                   
-        # label for new analysis....
-        mylabel = mylabel+datetime.now().strftime(" %x %X")
+        submitted = False
+        for itr in ready:
+            waiting.discard(itr)
+            mylabel, run_id, reason = _run_template_step(session_id, steps[itr], project, compiled.inputs[itr],
+                                                         queue=queue, dry_run=dry_run)
+            if not run_id:
+                if reason is None:
+                    decision, reason = "would-submit", ""
+                    planned[itr] = mylabel
+                    result["planned"].append(mylabel)
+                elif reason == SKIP_EXISTING:
+                    decision = "skipped"
+                    result["skipped"].append(mylabel)
+                elif reason.startswith(BLOCKED_PREREQUISITES) and deps[itr] & planned.keys():
+                    # dry run: the prerequisite step would have been submitted
+                    decision, reason = "waiting", "waiting on planned step " + planned[min(deps[itr] & planned.keys())]
+                    planned[itr] = mylabel
+                    result["waiting"].append(mylabel)
+                else:
+                    decision = "blocked"
+                    result["blocked"].append(mylabel)
+                    # only a prerequisite that can still complete keeps the session pending
+                    if reason.startswith(BLOCKED_PREREQUISITES) and not deps[itr] & stuck:
+                        result["waiting"].append(mylabel)
+                    else:
+                        stuck.add(itr)
+                result["plan"].append({"step": mylabel, "decision": decision, "reason": reason})
+                continue
+            result["submitted"].append(mylabel)
+            result["plan"].append({"step": mylabel, "decision": "submitted", "reason": ""})
+            submitted = True
+            
+            # only hold downstream steps for jobs we are willing to wait on
+            if steps[itr].get("sleep_seconds", 0) > 0:
+                if isinstance(run_id, Future):
+                    run_id = run_id.result()
+                job_id = get_job_id(run_id)
+                inflight[itr] = (job_id, watcher.watch(job_id, timeout=steps[itr]["sleep_seconds"]))
         
-        # pull inputs
-        myinputs = generate_inputs(full_session, json)
+        # new submissions in this pass, refresh session and analyses before the next pass
+        if submitted:
+            cache.invalidate("session", session_id)
+            cache.invalidate("analysis_index", session_id)
+    
+    # state of the session as seen now, used to skip unchanged sessions in later sweeps
+    full_session = cache.get_session(session_id)
+    result["session_modified"] = getattr(full_session, "modified", None)
+    result["analyses_modified"] = max((a.modified for a in full_session.analyses if getattr(a, "modified", None)), default=None)
+    # template analyses still queued or running: when they finish (or fail) nothing else has to change
+    # on the session, so later sweeps must check it again regardless
+    gear_names = {step["gear-name"] for step in steps}
+    result["unsettled"] = [record.label for record in get_analysis_index(full_session).records
+                           if record.gear_name in gear_names and record.state and record.state not in TERMINAL_STATES]
                                       
-        # pull config
-        myconfig = json["config"]
+    return result
 
-        # pull tags
-        mytags = json["tags"]
 
-        run_gear(gear, myconfig, myinputs, mytags, full_session, analysis_label=mylabel)
-        log.info('RUNNING gear: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
-        sleep(json["sleep_seconds"])
-                                      
-    return
-                                      
-        
+def get_compiled_template(project, template_file, version):
+    """Downloads, validates and compiles a project's gears template once per template version."""
+    def compile_template():
+        template = read_file_to_memory(template_file)
+        if template is None:
+            raise ValueError("unable to parse template file")
+        return CompiledTemplate(template, version)
+    return cache.get("template", (project.id, version), compile_template)
+
+
+def get_template_version(template_file):
+    # file hash (or modified timestamp) of the gears template, changes whenever the template is replaced
+    return str(getattr(template_file, "hash", None) or getattr(template_file, "modified", None))
+
+
+def select_sessions_to_check(sessions, checkpoint, template_file_name="gears_template_JSON.txt", max_workers=8):
+    """Filters sessions down to those that need to be evaluated again.
+
+    Session listings do not carry analyses, so the session-level analyses (their
+    latest `modified` and their job states) are fetched explicitly, one request per
+    session on `max_workers` threads. Sessions with an analysis still pending or
+    running are always selected.
+
+    Args:
+        sessions (list): session objects as returned by fw.sessions.find (need id, parents and modified).
+        checkpoint (checkpoint.SweepCheckpoint): state recorded by earlier sweeps.
+        template_file_name (str): name of the gears template (project file).
+        max_workers (int): number of sessions fetched at the same time.
+
+    Returns:
+        list: ids of sessions that changed, are new, or had something pending at the last sweep.
+    """
+    def template_version(session):
+        project = cache.get_project(session.parents["project"])
+        template_file = project.get_file(template_file_name)
+        return get_template_version(template_file) if template_file else None
+
+    def session_analyses(session):
+        return fw.get_session(session.id).analyses or []
+
+    # the checkpoint (sqlite) is only read from this thread, the pool only fetches
+    versions = {session.id: template_version(session) for session in sessions}
+    selected = {session.id for session in sessions if checkpoint.needs_check(session.id, versions[session.id], session.modified)}
+    unchanged = [session for session in sessions if session.id not in selected]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for session, analyses in zip(unchanged, pool.map(session_analyses, unchanged)):
+            running = any(getattr(a.job, "state", None) not in (None,) + TERMINAL_STATES for a in analyses if a.job)
+            analyses_modified = max((a.modified for a in analyses if getattr(a, "modified", None)), default=None)
+            if running or checkpoint.needs_check(session.id, versions[session.id], session.modified, analyses_modified):
+                selected.add(session.id)
+    selected = [session.id for session in sessions if session.id in selected]
+    log.info("Checkpoint: %s of %s sessions changed since the last sweep", len(selected), len(sessions))
+    return selected
+
+
+def run_auto_gear_sessions(session_ids, template_file_name="gears_template_JSON.txt", max_workers=4, cache_ttl=300,
+                           submit_rate=None, submit_workers=4, checkpoint=None):
+    """Applies the gears template to many sessions using a bounded pool of worker threads.
+
+    Each session is evaluated independently; an exception raised for one session
+    is logged and counted as a failure without stopping the rest of the sweep.
+
+    Args:
+        session_ids (list): flywheel session ids.
+        template_file_name (str): name of the gears template (project file).
+        max_workers (int): maximum number of sessions evaluated at the same time.
+        cache_ttl (float): seconds cached containers stay valid during the sweep.
+        submit_rate (float): if passed, all ready jobs of the sweep go through one
+            SubmissionQueue limited to this many submissions per second.
+        submit_workers (int): submissions in flight at the same time (with submit_rate).
+        checkpoint (checkpoint.SweepCheckpoint): if passed, the state of every evaluated session is recorded.
+
+    Returns:
+        dict: number of sessions with "submitted" jobs, "skipped" sessions (nothing to run),
+            "failed" sessions, and "errors" (session id -> error message). With submit_rate,
+            also "jobs" (destination id -> job ids) and "submit_errors"; a session whose
+            queued submissions all failed is counted as failed, not submitted.
+    """
+    summary = {"submitted": 0, "skipped": 0, "failed": 0, "errors": {}}
+    queued = {}     # session id -> jobs handed to the submission queue
+    sweep_cache = reset_cache(ttl=cache_ttl)
+    queue = SubmissionQueue(rate=submit_rate, max_workers=submit_workers) if submit_rate else None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {pool.submit(run_auto_gear, sid, template_file_name, queue): sid for sid in session_ids}
+        for future in as_completed(futures):
+            sid = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                log.warning("Session %s failed: %s", sid, e)
+                summary["failed"] += 1
+                summary["errors"][sid] = str(e)
+                if checkpoint:
+                    checkpoint.record(sid, None, None, None, pending=True)
+                continue
+
+            if checkpoint:
+                # other blocks (missing inputs, tags, completeness) only clear with a session edit,
+                # which the modified timestamps already catch
+                checkpoint.record(sid, result["template_version"], result["session_modified"], result["analyses_modified"],
+                                  pending=bool(result["submitted"] or result["waiting"] or result["unsettled"]))
+
+            if result["submitted"]:
+                summary["submitted"] += 1
+                queued[sid] = len(result["submitted"])
+            else:
+                summary["skipped"] += 1
+
+    if queue:
+        summary["jobs"] = queue.results()
+        summary["submit_errors"] = queue.errors()
+        queue.close()
+        log.info("Submitted %s jobs, %s submissions failed", sum(len(j) for j in summary["jobs"].values()),
+                 sum(len(e) for e in summary["submit_errors"].values()))
+        # sessions were counted when their jobs were queued, those whose submissions all failed are failures
+        for sid, errors in summary["submit_errors"].items():
+            if queued.get(sid) and len(errors) >= queued[sid]:
+                summary["submitted"] -= 1
+                summary["failed"] += 1
+                summary["errors"][sid] = "; ".join(errors)
+
+    log.info("Sweep complete: %s sessions submitted, %s skipped, %s failed",
+             summary["submitted"], summary["skipped"], summary["failed"])
+    summary["cache"] = sweep_cache.stats()
+    log.info("Container cache: %s hits, %s misses", summary["cache"]["total"]["hits"], summary["cache"]["total"]["misses"])
+
+    return summary
+
+
+def plan_auto_gear(session_ids, template_file_name="gears_template_JSON.txt", max_workers=4):
+    """Dry run of the gear autoworkflow: runs every check and input lookup, submits nothing.
+
+    Args:
+        session_ids (list): flywheel session ids.
+        template_file_name (str): name of the gears template (project file).
+        max_workers (int): maximum number of sessions evaluated at the same time.
+
+    Returns:
+        tuple: (plan, phases) DataFrames. `plan` has one row per session and template step with
+            the decision (would-submit | skipped | waiting | blocked) and reason ("" if none);
+            `waiting` steps depend on a step that would be submitted. `phases` has the wall time
+            and API calls spent per phase (analysis lookup, input resolution, checks, ...).
+
+    The plan runs on its own container cache, bound to a call-counting client, which
+    replaces the module cache until it returns: do not run it alongside another sweep
+    in the same process.
+    """
+    rows = []
+    profiler = profiling.start()
+    try:
+        # count client calls made while planning (the shared client reports them itself)
+        reset_cache(client=fw if is_instrumented(fw) else profiling.CountingClient(fw))
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {pool.submit(run_auto_gear, sid, template_file_name, None, True): sid for sid in session_ids}
+            for future in as_completed(futures):
+                sid = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    rows.append({"session.id": sid, "session": None, "step": None, "decision": "failed", "reason": str(e)})
+                    continue
+                if not result["plan"]:
+                    rows.append({"session.id": sid, "session": result["path"], "step": None, "decision": "skipped",
+                                 "reason": "no gears template"})
+                for row in result["plan"]:
+                    rows.append(dict({"session.id": sid, "session": result["path"]}, **row))
+    finally:
+        reset_cache()
+        profiling.stop()
+
+    plan = pd.DataFrame(rows, columns=["session.id", "session", "step", "decision", "reason"])
+    phases = pd.DataFrame(profiler.report(), columns=["phase", "count", "seconds", "api_calls"])
+
+    log.info("Plan: %s", ", ".join("%s %s" % (n, d) for d, n in plan["decision"].value_counts().items()))
+    return plan, phases
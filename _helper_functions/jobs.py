@@ -0,0 +1,156 @@
+import threading
+import time
+import logging
+from concurrent.futures import Future, ALL_COMPLETED, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+TERMINAL_STATES = ("complete", "failed", "cancelled")
+
+
+class JobTimeoutError(TimeoutError):
+    """Raised through a job's future when it does not finish within its timeout."""
+
+    def __init__(self, job_id, state):
+        super().__init__(f"Job {job_id} still {state} at timeout")
+        self.job_id = job_id
+        self.state = state
+
+
+class JobWatcher:
+    """Waits for many flywheel jobs with one batched query per poll.
+
+    Each watched job gets a `concurrent.futures.Future` that resolves to the
+    job's final state ("complete", "failed" or "cancelled"), or raises
+    JobTimeoutError if the job's own timeout passes first. The poll period
+    starts at `min_period`, grows by `backoff` while nothing changes (up to
+    `max_period`) and drops back to `min_period` as soon as a job changes state.
+
+    Args:
+        client (flywheel.Client): client used to query job states.
+        min_period (float): shortest wait between polls, seconds.
+        max_period (float): longest wait between polls, seconds.
+        backoff (float): factor the period grows by after a poll with no changes.
+        batch_size (int): maximum job ids per query.
+    """
+
+    def __init__(self, client, min_period=0.25, max_period=30, backoff=2.0, batch_size=100):
+        self.client = client
+        self.min_period = min_period
+        self.max_period = max_period
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.states = {}
+        self._watched = {}      # job id -> (future, deadline)
+        self._lock = threading.Lock()
+        self._batched = True
+
+    def watch(self, job_id, timeout=None, callback=None):
+        """Starts watching a job.
+
+        Args:
+            job_id (str): flywheel job id.
+            timeout (float): seconds to wait for this job, None waits forever.
+            callback (callable): called with the job's future once it is resolved.
+
+        Returns:
+            concurrent.futures.Future: resolves to the final job state.
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._watched[job_id] = (future, deadline)
+            self.states.setdefault(job_id, None)
+        return future
+
+    def forget(self, job_id):
+        """Stops tracking a job (its future is left as is)."""
+        with self._lock:
+            self._watched.pop(job_id, None)
+            self.states.pop(job_id, None)
+
+    def _query_states(self, job_ids):
+        # one query per batch of ids, fall back to single gets if the finder is not available
+        states = {}
+        if self._batched:
+            try:
+                for i in range(0, len(job_ids), self.batch_size):
+                    batch = job_ids[i:i + self.batch_size]
+                    for job in self.client.jobs.find(f"id=|[{','.join(batch)}]", limit=len(batch)):
+                        states[job.id] = job.state
+                return states
+            except Exception as e:
+                log.debug("Batched job query failed (%s), polling jobs one at a time", e)
+                self._batched = False
+        for jid in job_ids:
+            states[jid] = self.client.get_job(jid).state
+        return states
+
+    def poll(self):
+        """Queries all pending jobs once and resolves finished or timed-out futures.
+
+        Returns:
+            bool: True if any job changed state since the last poll.
+        """
+        with self._lock:
+            pending = [jid for jid, (future, _) in self._watched.items() if not future.done()]
+        if not pending:
+            return False
+
+        changed = False
+        now = time.monotonic()
+        states = self._query_states(pending)
+        for jid in pending:
+            state = states[jid].lower() if states.get(jid) else self.states.get(jid)
+            if state != self.states.get(jid):
+                changed = True
+                self.states[jid] = state
+            future, deadline = self._watched[jid]
+            if state in TERMINAL_STATES:
+                log.info('Job %s: completed with status: %s', jid, state)
+                future.set_result(state)
+            elif deadline is not None and now >= deadline:
+                log.info('Job %s: timeout while %s... continuing run script', jid, state)
+                future.set_exception(JobTimeoutError(jid, state))
+        return changed
+
+    def wait(self, timeout=None, return_when=ALL_COMPLETED):
+        """Polls until watched jobs are resolved.
+
+        Args:
+            timeout (float): overall seconds to wait, None waits until jobs resolve or hit their own timeout.
+            return_when: concurrent.futures.ALL_COMPLETED or FIRST_COMPLETED.
+
+        Returns:
+            dict: job id -> last known state for every watched job.
+        """
+        mustend = time.monotonic() + timeout if timeout is not None else None
+        period = self.min_period
+        while True:
+            changed = self.poll()
+
+            with self._lock:
+                futures = [future for future, _ in self._watched.values()]
+                deadlines = [d for future, d in self._watched.values() if d is not None and not future.done()]
+            done = [f for f in futures if f.done()]
+            if len(done) == len(futures) or (return_when == FIRST_COMPLETED and done):
+                break
+
+            now = time.monotonic()
+            if mustend is not None and now >= mustend:
+                break
+
+            period = self.min_period if changed else min(period * self.backoff, self.max_period)
+            # never sleep past the next per-job (or overall) deadline
+            wake = min(deadlines + ([mustend] if mustend is not None else []), default=now + period)
+            time.sleep(max(0, min(period, wake - now)))
+
+        return dict(self.states)
+
+    def start(self, **kwargs):
+        """Runs `wait` in a daemon thread so futures resolve in the background."""
+        thread = threading.Thread(target=self.wait, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
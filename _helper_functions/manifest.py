@@ -0,0 +1,183 @@
+"""
+Persistent record of downloaded files, shared by the download helpers.
+
+Every destination path passed to a DownloadManager with a manifest gets a row
+in a small sqlite database holding the flywheel file id, version, size and
+hash, and its transfer state:
+
+    pending -> in-flight -> done -> verified
+
+A killed job (e.g. a SLURM time limit) leaves its rows pending or in-flight;
+the next run with the same manifest skips every file that is done or
+verified and still unchanged on disk, and resumes the others (partial
+transfers continue from their `.part` file). Files are marked verified once
+their checksum matched the flywheel hash.
+
+    manifest = Manifest(os.path.join(download_path, ".download_manifest.db"))
+    with DownloadManager(max_workers=8, manifest=manifest) as manager:
+        ...
+    log.info(manifest.report())
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+IN_FLIGHT = "in-flight"
+DONE = "done"
+VERIFIED = "verified"
+STATES = (PENDING, IN_FLIGHT, DONE, VERIFIED)
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def parse_hash(value):
+    """Splits a flywheel file hash into (algorithm, hex digest), (None, None) if there is none."""
+    # flywheel hashes look like `v0-sha384-<hex>`, older ones are plain sha384 hex digests
+    if not value:
+        return None, None
+    parts = value.split("-")
+    if len(parts) == 3 and parts[1] in hashlib.algorithms_available:
+        return parts[1], parts[2]
+    return "sha384", value
+
+
+def file_digest(path, algorithm="sha384"):
+    """Returns the hex digest of a local file."""
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _file_id(file_entry):
+    return getattr(file_entry, "file_id", None) or getattr(file_entry, "id", None)
+
+
+class Manifest:
+    """Download states of files, stored in sqlite.
+
+    Args:
+        path (str): sqlite database file (created if needed).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                dest TEXT PRIMARY KEY,
+                file_id TEXT,
+                version INTEGER,
+                size INTEGER,
+                hash TEXT,
+                state TEXT,
+                local_size INTEGER,
+                local_mtime INTEGER,
+                updated REAL
+            )""")
+        # transfers of a killed run start over from pending (their .part files are kept)
+        self._db.execute("UPDATE files SET state = ? WHERE state = ?", (PENDING, IN_FLIGHT))
+        self._db.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self._db.commit()
+        return rows
+
+    def entry(self, dest):
+        """Returns the manifest row of `dest` as a dict, None if it is not recorded."""
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM files WHERE dest = ?", (dest,))
+            row = cursor.fetchone()
+            columns = [c[0] for c in cursor.description]
+        return dict(zip(columns, row)) if row else None
+
+    def is_complete(self, file_entry, dest):
+        """Checks whether `dest` holds this version of the file from an earlier (verified or done) transfer.
+
+        Files are compared by flywheel id, version and hash, and by their size and
+        mtime on disk, so nothing is read or hashed.
+        """
+        entry = self.entry(dest)
+        if not entry or entry["state"] not in (DONE, VERIFIED):
+            return False
+        if (entry["file_id"], entry["version"], entry["hash"]) != (
+                _file_id(file_entry), getattr(file_entry, "version", None), getattr(file_entry, "hash", None)):
+            return False
+        if entry["local_size"] is None:    # tracked task (e.g. an extracted zip), nothing on disk to compare
+            return True
+        try:
+            st = os.stat(dest)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == (entry["local_size"], entry["local_mtime"])
+
+    def add(self, file_entry, dest):
+        """Records `dest` as pending (keeps nothing of an earlier entry)."""
+        self._execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)",
+                      (dest, _file_id(file_entry), getattr(file_entry, "version", None),
+                       getattr(file_entry, "size", None), getattr(file_entry, "hash", None), PENDING, time.time()))
+
+    def set_state(self, dest, state):
+        """Sets the state of `dest`; DONE also records its size and mtime on disk (if it is a file)."""
+        local_size = local_mtime = None
+        if state == DONE and os.path.isfile(dest):
+            st = os.stat(dest)
+            local_size, local_mtime = st.st_size, st.st_mtime_ns
+        if state == DONE:
+            self._execute("UPDATE files SET state = ?, local_size = ?, local_mtime = ?, updated = ? WHERE dest = ?",
+                          (state, local_size, local_mtime, time.time(), dest))
+        else:
+            self._execute("UPDATE files SET state = ?, updated = ? WHERE dest = ?", (state, time.time(), dest))
+
+    def verify(self, dest):
+        """Compares the checksum of `dest` with its flywheel hash.
+
+        Returns:
+            bool: True if they match (the file is marked verified) or there is no hash
+            to compare (left done); False on a mismatch (marked pending).
+        """
+        entry = self.entry(dest)
+        algorithm, digest = parse_hash(entry["hash"] if entry else None)
+        if digest is None or entry["local_size"] is None:
+            return True
+        if file_digest(dest, algorithm) != digest:
+            self.set_state(dest, PENDING)
+            return False
+        self.set_state(dest, VERIFIED)
+        return True
+
+    def counts(self):
+        """Returns {state: (files, bytes)} over all recorded files."""
+        counts = {state: (0, 0) for state in STATES}
+        for state, n, size in self._execute("SELECT state, COUNT(*), COALESCE(SUM(size), 0) FROM files GROUP BY state"):
+            counts[state] = (n, size)
+        return counts
+
+    def remaining_bytes(self):
+        """Returns the bytes of the files still pending or in flight."""
+        counts = self.counts()
+        return counts[PENDING][1] + counts[IN_FLIGHT][1]
+
+    def report(self, mb_per_s=None):
+        """Returns files per state, MB remaining and, given the current throughput, the estimated seconds left."""
+        counts = self.counts()
+        report = {state: n for state, (n, _) in counts.items()}
+        remaining = counts[PENDING][1] + counts[IN_FLIGHT][1]
+        report["MB_remaining"] = round(remaining / 1e6, 1)
+        report["eta_seconds"] = round(remaining / 1e6 / mb_per_s) if mb_per_s else None
+        return report
+
+    def close(self):
+        self._db.close()
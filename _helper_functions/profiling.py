@@ -0,0 +1,90 @@
+import threading
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+log = logging.getLogger(__name__)
+
+_active = None
+_local = threading.local()
+
+
+class PhaseProfiler:
+    """Accumulates wall time and API calls per named phase, across threads.
+
+    Phases can be nested; time spent in an inner phase is only counted for
+    the inner phase, and API calls are attributed to the innermost phase
+    running on the calling thread ("other" outside of any phase).
+    """
+
+    def __init__(self):
+        self.stats = defaultdict(lambda: {"count": 0, "seconds": 0.0, "api_calls": 0})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        stack = _local.__dict__.setdefault("stack", [])
+        frame = [name, time.perf_counter(), 0.0]    # name, start, time spent in nested phases
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            if stack:
+                stack[-1][2] += elapsed
+            with self._lock:
+                self.stats[name]["count"] += 1
+                self.stats[name]["seconds"] += elapsed - frame[2]
+
+    def record_api_call(self, endpoint=None):
+        stack = _local.__dict__.get("stack")
+        name = stack[-1][0] if stack else "other"
+        with self._lock:
+            self.stats[name]["api_calls"] += 1
+
+    def report(self):
+        """Returns per-phase stats as a list of dicts, slowest phase first."""
+        rows = [dict(phase=name, **values) for name, values in self.stats.items()]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+
+def start():
+    """Starts collecting phase stats for the helper functions; returns the profiler."""
+    global _active
+    _active = PhaseProfiler()
+    return _active
+
+
+def stop():
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def phase(name):
+    """Context manager timing a phase of the active profiler (no-op when profiling is off)."""
+    return _active.phase(name) if _active else nullcontext()
+
+
+def record_api_call(endpoint=None):
+    if _active:
+        _active.record_api_call(endpoint)
+
+
+class CountingClient:
+    """Proxy around a flywheel client that reports each method call to the active profiler."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            record_api_call(name)
+            return attr(*args, **kwargs)
+        return counted
@@ -0,0 +1,209 @@
+import json
+import sqlite3
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from _helper_functions.client import get_client
+from _helper_functions.jobs import TERMINAL_STATES
+
+log = logging.getLogger(__name__)
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+class ProjectSnapshot:
+    """Local SQLite copy of the project metadata used by the reporting tables.
+
+    Holds sessions (subject, label, timestamp, tags, notes, completeness flag),
+    their analyses and job states, and selected project files (e.g. the gears
+    template). A refresh lists the project's sessions once and only re-fetches
+    sessions whose `modified` timestamp changed, or that still had a job
+    pending / running at the last refresh. Sessions removed from the project
+    are dropped.
+
+    Queries never touch the server; `ensure` refreshes first if the snapshot
+    is older than `max_age`, which bounds how stale a report can be.
+
+    Args:
+        path (str): sqlite database file, created if it does not exist.
+        max_age (float): seconds a snapshot is considered fresh.
+        client (flywheel.Client): client used for refreshes (default: the shared client).
+    """
+
+    def __init__(self, path, max_age=3600, client=None):
+        self.path = path
+        self.max_age = max_age
+        self.client = client or get_client()
+        self._db = sqlite3.connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS projects (
+                project_id TEXT PRIMARY KEY,
+                group_id TEXT,
+                label TEXT,
+                refreshed TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                project_id TEXT,
+                subject_label TEXT,
+                label TEXT,
+                timestamp TEXT,
+                modified TEXT,
+                run_downstream TEXT,
+                tags TEXT,
+                notes TEXT
+            );
+            CREATE TABLE IF NOT EXISTS analyses (
+                analysis_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                gear_name TEXT,
+                gear_version TEXT,
+                label TEXT,
+                job_id TEXT,
+                state TEXT,
+                position INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                project_id TEXT,
+                name TEXT,
+                content BLOB,
+                PRIMARY KEY (project_id, name)
+            );
+            CREATE INDEX IF NOT EXISTS sessions_project ON sessions (project_id);
+            CREATE INDEX IF NOT EXISTS analyses_session ON analyses (session_id);
+            """)
+        self._db.commit()
+
+    # ------------------------------- #
+    # ----------- refresh ----------- #
+    # ------------------------------- #
+
+    def project_id(self, group, label):
+        row = self._db.execute("SELECT project_id FROM projects WHERE group_id = ? AND label = ?", (group, label)).fetchone()
+        return row[0] if row else None
+
+    def age(self, group, label):
+        """Returns seconds since the project was last refreshed, None if it never was."""
+        row = self._db.execute("SELECT refreshed FROM projects WHERE group_id = ? AND label = ?", (group, label)).fetchone()
+        if not row:
+            return None
+        return (datetime.now() - datetime.fromisoformat(row[0])).total_seconds()
+
+    def ensure(self, group, label, files=(), max_workers=8):
+        """Returns the project id, refreshing first if the snapshot is missing, stale or lacks one of `files`."""
+        age = self.age(group, label)
+        project_id = self.project_id(group, label)
+        missing = [name for name in files if not project_id or not self.has_file(project_id, name)]
+        if age is None or age > self.max_age or missing:
+            return self.refresh(group, label, files=files, max_workers=max_workers)
+        log.debug("using snapshot of %s/%s (%.0f s old)", group, label, age)
+        return project_id
+
+    def refresh(self, group, label, files=(), max_workers=8):
+        """Brings the snapshot of one project up to date with the server.
+
+        Args:
+            group (str): flywheel group id.
+            label (str): project label.
+            files (list): names of project files to store (e.g. the gears template).
+            max_workers (int): number of sessions fetched in parallel.
+
+        Returns:
+            str: project id.
+        """
+        fw = self.client
+        project = fw.projects.find_one('label='+label+',group='+group)
+        project = fw.get_project(project.id)
+
+        listing = {ses.id: _timestamp(ses.modified) for ses in project.sessions.find()}
+        known = dict(self._db.execute("SELECT session_id, modified FROM sessions WHERE project_id = ?", (project.id,)))
+        unsettled = {row[0] for row in self._db.execute(
+            "SELECT DISTINCT a.session_id FROM analyses a JOIN sessions s ON s.session_id = a.session_id "
+            "WHERE s.project_id = ? AND a.state NOT IN (%s)" % ",".join("?" * len(TERMINAL_STATES)),
+            (project.id,) + tuple(TERMINAL_STATES))}
+        to_fetch = [sid for sid, modified in listing.items()
+                    if known.get(sid) != modified or sid in unsettled]
+        removed = [sid for sid in known if sid not in listing]
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            full_sessions = list(pool.map(fw.get_session, to_fetch))
+
+        with self._db:
+            for sid in removed + to_fetch:
+                self._db.execute("DELETE FROM analyses WHERE session_id = ?", (sid,))
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (sid,))
+            for full_session in full_sessions:
+                self._store_session(project.id, full_session, listing[full_session.id])
+            for name in files:
+                file_entry = project.get_file(name)
+                self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                                 (project.id, name, file_entry.read() if file_entry else None))
+            self._db.execute("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+                             (project.id, group, label, datetime.now().isoformat()))
+
+        log.info("snapshot %s/%s: %s sessions, %s re-fetched, %s removed",
+                 group, label, len(listing), len(to_fetch), len(removed))
+        return project.id
+
+    def _store_session(self, project_id, full_session, modified):
+        info = full_session.info or {}
+        run_downstream = info["COMPLETENESS"]["Run Downstream Analyses"] if "COMPLETENESS" in info else None
+        self._db.execute(
+            "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (full_session.id, project_id, full_session.subject.label, full_session.label,
+             _timestamp(full_session.timestamp), modified, json.dumps(run_downstream),
+             json.dumps(list(full_session.tags or [])), " ".join([x["text"] for x in full_session.notes])))
+        for position, analysis in enumerate(full_session.analyses or []):
+            # only flywheel jobs (not uploads)
+            if not analysis.job:
+                continue
+            self._db.execute(
+                "INSERT INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (analysis.id, full_session.id, analysis.gear_info.name, analysis.gear_info["version"],
+                 analysis.label, analysis.job.id, analysis.job.state, position))
+
+    # ------------------------------- #
+    # ----------- queries ----------- #
+    # ------------------------------- #
+
+    def sessions(self, project_id, skip_tags=("pilot",)):
+        """Returns the project's sessions in the layout of tables.SESSION_COLUMNS (plus `tags`)."""
+        table = pd.read_sql_query(
+            'SELECT s.timestamp, s.subject_label AS "subject.label", s.label AS "session.label", s.session_id AS flywheel_id, '
+            'p.label AS project, s.run_downstream AS "Run Downstream Analyses", s.notes AS Notes, s.tags '
+            "FROM sessions s JOIN projects p ON p.project_id = s.project_id WHERE s.project_id = ?",
+            self._db, params=(project_id,))
+        table["timestamp"] = pd.to_datetime(table["timestamp"], format="ISO8601")
+        table["Run Downstream Analyses"] = table["Run Downstream Analyses"].map(json.loads)
+        table["tags"] = table["tags"].map(json.loads)
+        if skip_tags:
+            table = table[[not set(skip_tags) & set(tags) for tags in table["tags"]]].reset_index(drop=True)
+        return table
+
+    def analyses(self, project_id):
+        """Returns the analyses of the project's sessions in the layout of tables.ANALYSIS_COLUMNS."""
+        return pd.read_sql_query(
+            'SELECT a.session_id AS flywheel_id, gear_name AS "gear.name", gear_version AS "gear.version", '
+            'a.label AS "analysis.label", state AS "analysis.state", analysis_id AS "analysis.id", job_id AS "job.id" '
+            "FROM analyses a JOIN sessions s ON s.session_id = a.session_id WHERE s.project_id = ? "
+            "ORDER BY a.session_id, position",
+            self._db, params=(project_id,))
+
+    def has_file(self, project_id, name):
+        # stored at a refresh, even if the project has no such file
+        return self._db.execute("SELECT 1 FROM files WHERE project_id = ? AND name = ?", (project_id, name)).fetchone() is not None
+
+    def file_content(self, project_id, name):
+        """Returns the stored content of a project file, None if the project has no such file."""
+        row = self._db.execute("SELECT content FROM files WHERE project_id = ? AND name = ?", (project_id, name)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self._db.close()
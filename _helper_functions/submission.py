@@ -0,0 +1,126 @@
+import threading
+import time
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+import flywheel
+
+log = logging.getLogger(__name__)
+
+
+class SubmissionQueue:
+    """Rate-limited, concurrent queue for gear job submissions.
+
+    Jobs are submitted by a pool of worker threads, no faster than `rate`
+    submissions per second across all workers. Server errors (HTTP 5xx) are
+    retried with exponential backoff; other errors fail the job's future.
+
+    Args:
+        rate (float): maximum submissions per second, None for no limit.
+        max_workers (int): number of submissions in flight at the same time.
+        retries (int): attempts per job on a 5xx response (a job is always attempted once).
+        retry_delay (float): seconds before the first retry, doubled on each retry.
+    """
+
+    def __init__(self, rate=2.0, max_workers=4, retries=3, retry_delay=2.0):
+        self.rate = rate
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+        self._futures = []
+        self._destinations = {}     # future -> destination id
+
+    def _wait_for_slot(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        time.sleep(max(0, slot - now))
+
+    def _run(self, gear, config, inputs, tags, dest, analysis_label):
+        label = analysis_label or gear['gear']['name']+datetime.now().strftime(" %x %X")
+        delay = self.retry_delay
+        attempts = max(1, self.retries)
+        for attempt in range(attempts):
+            self._wait_for_slot()
+            try:
+                gear_job_id = gear.run(analysis_label=label, config=config, inputs=inputs, tags=tags, destination=dest)
+                log.debug('Submitted job %s', gear_job_id)
+                return gear_job_id
+            except flywheel.rest.ApiException as e:
+                if (e.status or 0) < 500 or attempt == attempts - 1:
+                    log.error('Submission of %s to %s failed: %s', label, dest.id, e)
+                    raise
+                log.warning('Server error submitting %s (%s), retrying in %s seconds...', label, e.status, delay)
+                time.sleep(delay)
+                delay *= 2
+
+    def submit(self, gear, config, inputs, tags, dest, analysis_label=None):
+        """Queues a job, same arguments as gears.run_gear.
+
+        Returns:
+            concurrent.futures.Future: resolves to the id returned by gear.run.
+        """
+        future = self._pool.submit(self._run, gear, config, inputs, tags, dest, analysis_label)
+        with self._lock:
+            self._futures.append(future)
+            self._destinations[future] = dest.id
+        return future
+
+    def results(self):
+        """Waits for all queued jobs and maps each destination id to its submitted job ids."""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        mapping = defaultdict(list)
+        for future in futures:
+            if not future.exception():
+                mapping[self._destinations[future]].append(future.result())
+        return dict(mapping)
+
+    def errors(self):
+        """Waits for all queued jobs and returns destination id -> list of submission errors."""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        errors = defaultdict(list)
+        for future in futures:
+            if future.exception():
+                errors[self._destinations[future]].append(str(future.exception()))
+        return dict(errors)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def submit_batch(jobs, rate=2.0, max_workers=4, retries=3):
+    """Submits many (gear, inputs, config, destination) tuples through a SubmissionQueue.
+
+    Args:
+        jobs (list): tuples of (gear, inputs, config, destination) or
+            (gear, inputs, config, destination, tags, analysis_label).
+        rate (float): maximum submissions per second.
+        max_workers (int): number of submissions in flight at the same time.
+        retries (int): attempts per job on a 5xx response.
+
+    Returns:
+        dict: destination id -> list of submitted job ids.
+    """
+    with SubmissionQueue(rate=rate, max_workers=max_workers, retries=retries) as queue:
+        for job in jobs:
+            gear, inputs, config, dest = job[0:4]
+            tags = job[4] if len(job) > 4 else []
+            analysis_label = job[5] if len(job) > 5 else None
+            queue.submit(gear, config, inputs, tags, dest, analysis_label=analysis_label)
+        return queue.results()
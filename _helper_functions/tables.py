@@ -1,15 +1,269 @@
 import sys, os, logging
-import flywheel
 from datetime import datetime, date
 import pandas as pd
 import re
 import json
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from _helper_functions.client import get_client
+from _helper_functions.templates import step_label
+from _helper_functions.writers import table_writer
 
-fw = flywheel.Client('')
+fw = get_client()
 log = logging.getLogger(__name__)
 
-        
-def get_table_by_gearname(pycontext, gearname):
+
+def walk_sessions(project, max_workers=8, skip_tags=("pilot",), skip_ids=()):
+    """Yields the full session objects of a project, fetched concurrently.
+
+    At most `max_workers` sessions are fetched at the same time, and at most twice
+    that many are held waiting to be consumed. Sessions are yielded in the order
+    their fetch completes (not in project order).
+
+    Args:
+        project (flywheel.Project): project container.
+        max_workers (int): number of sessions fetched in parallel.
+        skip_tags (tuple): sessions carrying any of these tags are not yielded.
+        skip_ids (set): ids of sessions not to fetch (e.g. already written by a resumed run).
+    """
+    sessions = (ses for ses in project.sessions.find() if ses.id not in skip_ids)
+    max_workers = max(1, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        while True:
+            for ses in islice(sessions, 2 * max_workers - len(pending)):
+                pending.add(pool.submit(fw.get_session, ses.id))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                full_session = future.result()
+                if set(skip_tags) & set(full_session.tags):
+                    continue
+                yield full_session
+
+
+GEARNAME_COLUMNS = ["timestamp", "subject.label", "session.label", "session.id", "project", "Run Downstream Analyses",
+                    "gear.name", "gear.version", "analysis.label", "analysis.state", "analysis.id", "cli.cmd", "Notes"]
+SESSION_COLUMNS = ["timestamp", "subject.label", "session.label", "flywheel_id", "project", "Run Downstream Analyses", "Notes"]
+ANALYSIS_COLUMNS = ["flywheel_id", "gear.name", "gear.version", "analysis.label", "analysis.state", "analysis.id"]
+
+
+def build_frame(rows, columns):
+    """Builds a DataFrame from an iterable of row dicts in one go (rows are collected column by column)."""
+    data = {column: [] for column in columns}
+    for row in rows:
+        for column in columns:
+            data[column].append(row[column])
+    return pd.DataFrame(data, columns=columns)
+
+
+def template_columns(template):
+    """Returns (gear name, gear version or None, analysis label) for each step of a gears template."""
+    return [(step["gear-name"], step.get("gear-version"), step_label(step)) for step in template["analysis"]]
+
+
+def session_row(full_session, project_label):
+    return {"timestamp": full_session.timestamp,
+            "subject.label": full_session.subject.label,
+            "session.label": full_session.label,
+            "flywheel_id": str(full_session.id),
+            "project": project_label,
+            "Run Downstream Analyses": full_session.info["COMPLETENESS"]["Run Downstream Analyses"] if "COMPLETENESS" in full_session.info else None,
+            "Notes": " ".join([x["text"] for x in full_session.notes])}
+
+
+def analysis_rows(full_session):
+    # one record per flywheel job analysis (not uploads) of a session
+    for analysis in full_session.analyses:
+        if not analysis.job:
+            continue
+        yield {"flywheel_id": str(full_session.id),
+               "gear.name": analysis.gear_info.name,
+               "gear.version": analysis.gear_info["version"],
+               "analysis.label": analysis.label,
+               "analysis.state": analysis.job.state,
+               "analysis.id": str(analysis.id)}
+
+
+def fill_template_columns(table, analyses, columns):
+    """Adds one column per template gear holding the id of the session's matching complete analysis.
+
+    An analysis matches a template gear if gear name (and version, if the template pins one)
+    are equal and the template label is part of the analysis label. If several analyses match,
+    the last one wins; sessions without a match keep an empty string.
+
+    Args:
+        table (pd.DataFrame): session table with a `flywheel_id` column.
+        analyses (pd.DataFrame): analysis records (ANALYSIS_COLUMNS) of those sessions.
+        columns (list): (gear name, gear version, label) entries, see template_columns.
+    """
+    for _, _, label in columns:
+        table[label] = ""
+
+    complete = analyses[analyses["analysis.state"] == "complete"]
+    for name, version, label in columns:
+        match = complete[complete["gear.name"] == name]
+        if version is not None:
+            match = match[match["gear.version"] == version]
+        match = match[match["analysis.label"].str.contains(label, regex=False)]
+        ids = match.drop_duplicates("flywheel_id", keep="last").set_index("flywheel_id")["analysis.id"]
+        table[label] = table["flywheel_id"].map(ids).fillna(table[label])
+    return table
+
+
+def _find_project(pycontext):
+    # locate the flywheel project and pull the full object
+    project = fw.projects.find_one('label='+pycontext["project"]+',group='+pycontext["group"])
+    return fw.get_project(project.id)
+
+
+def gearname_rows(full_session, project_label, pycontext):
+    """Yields one table row (dict) per analysis of `pycontext["gear"]` in one session."""
+    gear = pycontext["gear"]
+    for analysis in full_session.analyses:
+
+        # only explore flywheel jobs (not uploads)
+        if not analysis.job:
+            continue
+
+        # only keep the ones that match gear, version and analysis label
+        if gear != analysis.gear_info.name:
+            continue
+        if "version" in pycontext and not re.search(pycontext["version"], analysis.gear_info["version"]):
+            continue
+        if "regex" in pycontext and pycontext["regex"] not in analysis.label:
+            continue
+
+        # we met all conditions, store in table now
+        yield {"timestamp": full_session.timestamp,
+               "subject.label": full_session.subject.label,
+               "session.label": full_session.label,
+               "session.id": str(full_session.id),
+               "project": project_label,
+               "Run Downstream Analyses": "COMPLETENESS" in full_session.info and full_session.info["COMPLETENESS"]["Run Downstream Analyses"] or None,
+               "gear.name": analysis.gear_info.name,
+               "gear.version": analysis.gear_info["version"],
+               "analysis.label": analysis.label,
+               "analysis.state": analysis.job.state,
+               "analysis.id": analysis.id,
+               "cli.cmd": 'fw download -o download.zip "{}/{}/{}/{}/{}"'.format(project_label, full_session.subject.label, full_session.label, "analyses", analysis.label),
+               "Notes": " ".join([x["text"] for x in full_session.notes])}
+
+
+def iter_gearname_rows(pycontext, max_workers=8):
+    """Yields one table row (dict) per analysis of `pycontext["gear"]` in the project.
+
+    Rows stream in as sessions are fetched; the rows of one session are consecutive.
+
+    Args:
+        pycontext (dict): project, group, gear and optionally version (regex) and regex (label substring).
+        max_workers (int): number of sessions fetched in parallel.
+    """
+    project = _find_project(pycontext)
+    for full_session in walk_sessions(project, max_workers=max_workers):
+        yield from gearname_rows(full_session, project.label, pycontext)
+
+
+def template_row(full_session, project_label, columns):
+    """Returns the template table row of one session (see get_table_by_template)."""
+    row = session_row(full_session, project_label)
+    notes = row.pop("Notes")
+    records = [r for r in analysis_rows(full_session) if r["analysis.state"] == "complete"]
+    for name, version, label in columns:
+        row.setdefault(label, "")
+        for record in records:
+            if record["gear.name"] == name and version in (None, record["gear.version"]) and label in record["analysis.label"]:
+                row[label] = record["analysis.id"]
+    row["Notes"] = notes
+    return row
+
+
+def template_table_columns(columns):
+    # session columns, one column per template label, notes last
+    labels = list(dict.fromkeys(label for _, _, label in columns))
+    return SESSION_COLUMNS[:-1] + labels + ["Notes"]
+
+
+def read_template(project, template_file_name):
+    """Returns the parsed gears template stored as a project file, None if missing or invalid."""
+    template_file = project.get_file(template_file_name)
+    if not template_file:
+        log.info(f"{template_file_name} not found within project: {project.label}. Skipping...")
+        return None
+    log.info("analysis template: %s", template_file.name)
+    try:
+        return json.loads(template_file.read().decode('utf-8'))  # Decode bytes to string and load JSON
+    except json.JSONDecodeError as e:
+        log.error("Failed to parse JSON: %s", e)
+        return None
+
+
+def write_gearname_table(pycontext, gearname, path, max_workers=8, resume=True):
+    """Streams the get_table_by_gearname rows to a csv (or *.parquet) file as sessions are fetched.
+
+    Progress is checkpointed per session; an interrupted run continues with the sessions
+    that were not written yet. Rows are in the order sessions were fetched (not sorted).
+
+    Returns:
+        int: number of rows written by this run.
+    """
+    pycontext["gear"] = gearname
+    project = _find_project(pycontext)
+    written = 0
+    with table_writer(path, GEARNAME_COLUMNS, key="session.id", resume=resume) as writer:
+        for full_session in walk_sessions(project, max_workers=max_workers, skip_ids=writer.done):
+            rows = list(gearname_rows(full_session, project.label, pycontext))
+            written += writer.write_rows(rows)
+            if not rows:
+                writer.mark_done(str(full_session.id))
+    log.info("wrote %s rows to %s", written, path)
+    return written
+
+
+def write_template_table(user_inputs, path, template_file_name="gear_template.json", max_workers=8, resume=True):
+    """Streams the get_table_by_template rows to a csv (or *.parquet) file as sessions are fetched.
+
+    Progress is checkpointed per session; an interrupted run continues with the sessions
+    that were not written yet. Rows are in the order sessions were fetched (not sorted).
+
+    Returns:
+        int: number of rows written by this run, None if the project has no (valid) template.
+    """
+    project = _find_project(user_inputs)
+    template = read_template(project, template_file_name)
+    if template is None:
+        return None
+    columns = template_columns(template)
+    written = 0
+    with table_writer(path, template_table_columns(columns), key="flywheel_id", resume=resume) as writer:
+        for full_session in walk_sessions(project, max_workers=max_workers, skip_ids=writer.done):
+            written += writer.write_rows([template_row(full_session, project.label, columns)])
+    log.info("wrote %s rows to %s", written, path)
+    return written
+
+
+def gearname_table_from_snapshot(snapshot, pycontext, max_workers=8):
+    """Same rows as iter_gearname_rows, queried from a ProjectSnapshot (refreshed first if stale)."""
+    project_id = snapshot.ensure(pycontext["group"], pycontext["project"], max_workers=max_workers)
+    sessions = snapshot.sessions(project_id)
+    analyses = snapshot.analyses(project_id)
+
+    match = analyses[analyses["gear.name"] == pycontext["gear"]]
+    if "version" in pycontext:
+        match = match[match["gear.version"].str.contains(pycontext["version"], regex=True)]
+    if "regex" in pycontext:
+        match = match[match["analysis.label"].str.contains(pycontext["regex"], regex=False)]
+
+    summary = sessions.merge(match, on="flywheel_id")
+    summary["session.id"] = summary["flywheel_id"]
+    summary["Run Downstream Analyses"] = summary["Run Downstream Analyses"].map(lambda value: value or None)
+    summary["cli.cmd"] = ['fw download -o download.zip "{}/{}/{}/{}/{}"'.format(*values) for values in zip(
+        summary["project"], summary["subject.label"], summary["session.label"], ["analyses"] * len(summary), summary["analysis.label"])]
+    return summary[GEARNAME_COLUMNS]
+
+
+def get_table_by_gearname(pycontext, gearname, max_workers=8, snapshot=None):
     
     pycontext["gear"] = gearname
     log.info("Using Configuration Settings: ")
@@ -23,162 +277,68 @@ def get_table_by_gearname(pycontext, gearname):
         log.info("analysis label regex: %s", str(pycontext["regex"]))
     log.parent.handlers[0].setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
     
-    summary=pd.DataFrame()
-
-    # find flywheel project
-    project = fw.projects.find_one('label='+pycontext["project"]+',group='+pycontext["group"])
-    
-    # get full flywheel object
-    project = fw.get_project(project.id)
-    
-    # get gear-name
-    gear = pycontext["gear"]
-    
-    # loop session in project
-    for ses in project.sessions.find():
-
-        full_session=fw.get_session(ses.id)
-
-        if  "pilot" in full_session.tags:
-            continue
-        
-        # loop analyses in session TODO: Find a more generic walker strategy
-        for analysis in full_session.analyses:
-            
-            # only explore flywheel jobs (not uploads)
-            if not analysis.job:
-                continue
-
-        for analysis in full_session.analyses:
-            if not analysis.job:
-                continue
-            
-            #only print ones that match the analysis label
-            if pycontext["gear"] == analysis.gear_info.name:
-                if "version" in pycontext:
-                    r1 = re.compile(pycontext["version"])
-                    if not r1.search(analysis.gear_info["version"]):
-                        continue
-                if "regex" in pycontext and pycontext["regex"] not in analysis.label:
-                    continue
-                
-                # we met all conditions, store in table now
-                df=pd.DataFrame({"timestamp":full_session.timestamp, 
-                                 "subject.label":full_session.subject.label, 
-                                 "session.label":full_session.label,
-                                 "session.id": str(full_session.id),
-                                 "project": fw.get_container(full_session.project).label,
-                                 "Run Downstream Analyses": "COMPLETENESS" in full_session.info and full_session.info["COMPLETENESS"]["Run Downstream Analyses"] or None,
-                                 "gear.name": analysis.gear_info.name,
-                                 "gear.version": analysis.gear_info["version"],
-                                 "analysis.label": analysis.label,
-                                 "analysis.state": analysis.job.state,
-                                 "analysis.id": analysis.id,
-                                 "cli.cmd": 'fw download -o download.zip "{}/{}/{}/{}/{}"'.format(fw.get_container(full_session.project).label,full_session.subject.label, full_session.label,"analyses",analysis.label),
-                                 "Notes": " ".join([x["text"] for x in full_session.notes])}, index=[0])
-            
-
-
-                summary = pd.concat([summary, df])
+    if snapshot is not None:
+        summary = gearname_table_from_snapshot(snapshot, pycontext, max_workers=max_workers)
+    else:
+        # sessions are fetched in parallel, matching analyses stream in as they are found
+        summary = build_frame(iter_gearname_rows(pycontext, max_workers=max_workers), GEARNAME_COLUMNS)
 
     summary = summary.sort_values('timestamp', ignore_index = True)
     
     return summary
 
         
-def get_table_by_template(user_inputs, template_file_name="gear_template.json"):
+def get_table_by_template(user_inputs, template_file_name="gear_template.json", max_workers=8, snapshot=None):
     
     log.info("Using Configuration Settings: ")
     log.parent.handlers[0].setFormatter(logging.Formatter('\t%(message)s'))
     log.info("project: %s", str(user_inputs["project"]))
 
-    # get project specifics
-    project = fw.projects.find_one(f'label={user_inputs["project"]},group={user_inputs["group"]}')
-    
-    template_file = project.get_file(template_file_name)
-    if not template_file:
-        log.info(f"{template_file_name} not found within project: {project.label}. Skipping...")
-        return
-    
-    log.info("analysis template: %s", template_file.name)
+    if snapshot is not None:
+        # query the local snapshot, refreshed first if older than its staleness bound
+        project_id = snapshot.ensure(user_inputs["group"], user_inputs["project"], files=[template_file_name],
+                                     max_workers=max_workers)
+        file_content = snapshot.file_content(project_id, template_file_name)
+        if file_content is None:
+            log.info(f"{template_file_name} not found within project: {user_inputs['project']}. Skipping...")
+            return
+        log.info("analysis template: %s (snapshot)", template_file_name)
+        try:
+            template = json.loads(file_content.decode('utf-8'))  # Decode bytes to string and load JSON
+        except json.JSONDecodeError as e:
+            log.error("Failed to parse JSON: %s", e)
+            return
+    else:
+        # get project specifics
+        project = fw.projects.find_one(f'label={user_inputs["project"]},group={user_inputs["group"]}')
+        template = read_template(project, template_file_name)
+        if template is None:
+            return
     log.parent.handlers[0].setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 
-    file_content = template_file.read()
-    try:
-        template = json.loads(file_content.decode('utf-8'))  # Decode bytes to string and load JSON
-    except json.JSONDecodeError as e:
-        print(f"Failed to parse JSON: {e}")
-        return
-
-    # STEP 1: create dataframe with all sessions and info
-    table = pd.DataFrame()
-    for ses in project.sessions.find():
-
-        full_session=fw.get_session(ses.id)
-
-        if  "pilot" in full_session.tags:
-            continue
-
-        df=pd.DataFrame({"timestamp": full_session.timestamp,
-                         "subject.label":full_session.subject.label, 
-                         "session.label":full_session.label,
-                         "flywheel_id": str(full_session.id),
-                         "project": fw.get_container(full_session.project).label,
-                         "Run Downstream Analyses": full_session.info["COMPLETENESS"]["Run Downstream Analyses"] if "COMPLETENESS" in full_session.info else None,
-                         "Notes": " ".join([x["text"] for x in full_session.notes])}, index=[0])
-        table = pd.concat([table,df], ignore_index = True)
+    # STEP 1: one pass over the sessions, collecting session info and all analyses
+    if snapshot is not None:
+        table = snapshot.sessions(project_id)[SESSION_COLUMNS]
+        analyses = snapshot.analyses(project_id)[ANALYSIS_COLUMNS]
+    else:
+        rows = []
+        records = []
+        for full_session in walk_sessions(project, max_workers=max_workers):
+            rows.append(session_row(full_session, project.label))
+            records.extend(analysis_rows(full_session))
+        table = build_frame(rows, SESSION_COLUMNS)
+        analyses = build_frame(records, ANALYSIS_COLUMNS)
     
     log.info('adding %s sessions...', len(table))
+    log.debug('found %s analyses in %s sessions', len(analyses), len(table))
     
-    # STEP 2: Sort Columns to Pull
-    gears_dict = {}
-    for itr, itr_template in enumerate(template["analysis"]):
-
-        # analysis information...
-        my_gear_name=itr_template["gear-name"]+"/"+itr_template["gear-version"] if "gear-version" in itr_template else itr_template["gear-name"]
-        my_gear_label = itr_template["custom-label"] if "custom-label" in itr_template else itr_template["gear-name"]
-        
-        # what if gear names are used more than once...
-        ii=0
-        while my_gear_name in gears_dict.keys():
-            my_gear_name += "+"
-            ii += 1
-            if ii > 10:
-                break
-
-        gears_dict.update({my_gear_name: my_gear_label})
-    
-    log.info('adding %s analyses from template...', len(gears_dict))
+    # STEP 2: Sort Columns to Pull (gear names may be used more than once)
+    columns = template_columns(template)
     
-    #initalize columns
-    for gear in gears_dict.keys():
-        gear_label = gears_dict[gear]
-        table[gear_label] = ""
+    log.info('adding %s analyses from template...', len(columns))
     
-    # STEP 3: fill in analysis columns
-    for idx, row in table.iterrows():
-        full_session = fw.get_session(row["flywheel_id"])
-        analyses = full_session.analyses
-        for g in gears_dict.keys():
-            # store gear label 
-            g_label = gears_dict[g]
-            
-            # remove placeholder for repeat columns...
-            gear_name = g.replace("+","")
-            
-            # loop through analyses to find match...
-            for analysis in analyses:
-                print(analysis.label)
-                if not analysis.job:
-                    continue
-                print(table.loc[idx, g_label])
-                if analysis.job.state == "complete":
-                    if "/" in g:   ## this is a gear + version
-                        if (analysis.gear_info.name == gear_name.split("/")[0]) and (analysis.gear_info.version == gear_name.split("/")[1]) and (g_label in analysis.label):
-                            table.loc[idx, g_label] = str(analysis.id)
-                    else:
-                        if (analysis.gear_info.name == gear_name) and (g_label in analysis.label):
-                            table.loc[idx, g_label] = str(analysis.id)
+    # STEP 3: fill in analysis columns, joined against the analyses found in step 1
+    table = fill_template_columns(table, analyses, columns)
     
     # make sure notes are last column
     column_to_move = table.pop("Notes")
@@ -0,0 +1,197 @@
+import re
+import logging
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+
+
+def step_gear_name(step):
+    # gear name including version (if passed in template), used for gear lookup and analysis checks
+    return step["gear-name"]+"/"+step["gear-version"] if "gear-version" in step else step["gear-name"]
+
+
+def step_label(step):
+    return step["custom-label"] if "custom-label" in step else step["gear-name"]
+
+
+def _prereq_matches(prereq, step):
+    # a template step satisfies a prerequisite if gear name (and version pattern / analysis label) agree
+    prereq_gear = prereq["prereq-gear"]
+    if "/" in prereq_gear:
+        name, version = prereq_gear.split("/")[0:2]
+    else:
+        name, version = prereq_gear, None
+    if step["gear-name"] != name:
+        return False
+    if version and "gear-version" in step and not re.search(version, step["gear-version"]):
+        return False
+    if "prereq-analysis-label" in prereq and prereq["prereq-analysis-label"] not in step_label(step):
+        return False
+    return True
+
+
+_warned = set()
+_warned_lock = threading.Lock()
+
+
+def _warn_once(message):
+    # sessions of a sweep compile the same template concurrently
+    with _warned_lock:
+        if message in _warned:
+            return
+        _warned.add(message)
+    log.warning(message)
+
+
+def build_template_graph(template):
+    """Builds the dependency graph of the steps in a gears template.
+
+    Each step depends on every other template step that satisfies one of its
+    `prerequisites`. A prerequisite matching no step is external (an analysis made
+    by a gear rule or a manual run): it adds no edge and is only checked against
+    the session's analyses (see gears.check_step). The template is rejected up
+    front if prerequisites form a cycle.
+
+    Args:
+        template (dict): gears template (see 2_gear_autoworkflow/README.md).
+
+    Returns:
+        list: for each step (same order as template["analysis"]), the set of step indices it depends on.
+
+    Raises:
+        ValueError: if the prerequisites form a cycle.
+    """
+    steps = template["analysis"]
+    deps = []
+    for itr, step in enumerate(steps):
+        step_deps = set()
+        for prereq in step.get("prerequisites", []):
+            matches = {j for j, other in enumerate(steps) if j != itr and _prereq_matches(prereq, other)}
+            if not matches:
+                _warn_once("step %s (%s): prerequisite %s does not match any step in the template, expecting it "
+                           "from outside the template" % (itr + 1, step_label(step), prereq["prereq-gear"]))
+            step_deps |= matches
+        deps.append(step_deps)
+
+    # Kahn's algorithm, whatever is left over is part of (or waits on) a cycle
+    remaining = set(range(len(steps)))
+    while True:
+        ready = {i for i in remaining if not deps[i] & remaining}
+        if not ready:
+            break
+        remaining -= ready
+    if remaining:
+        raise ValueError("prerequisite cycle between template steps: %s"
+                         % ", ".join("%s (%s)" % (i + 1, step_label(steps[i])) for i in sorted(remaining)))
+
+    return deps
+
+
+# ------------------------------- #
+# ------ template compiler ------ #
+# ------------------------------- #
+
+INPUT_SOURCES = ("parent-container", "find-analysis", "find-analysis-label")
+INPUT_MATCHES = ("value", "regex")
+PARENT_CONTAINERS = ("project", "subject", "session")
+
+# Flywheel labels that can be inserted into searchable file names (see apply_lookup)
+PLACEHOLDER = re.compile(r"\{(SUBJECT|SESSION)\}")
+
+InputSpec = namedtuple("InputSpec", ["key", "source", "source_value", "match", "pattern", "static", "optional"])
+
+
+@lru_cache(maxsize=4096)
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+def validate_template(template):
+    """Returns a list of problems found in a gears template (empty if the template is valid)."""
+    if not isinstance(template, dict) or not isinstance(template.get("analysis"), list):
+        return ["template must contain an 'analysis' list"]
+
+    errors = []
+    for itr, step in enumerate(template["analysis"]):
+        where = "step %s" % (itr + 1)
+        if "gear-name" not in step:
+            errors.append(where + ": missing 'gear-name'")
+            continue
+        where += " (%s)" % step_label(step)
+        for prereq in step.get("prerequisites", []):
+            if "prereq-gear" not in prereq:
+                errors.append(where + ": prerequisite without 'prereq-gear'")
+        for key, spec in step.get("inputs", {}).items():
+            sources = [s for s in INPUT_SOURCES if s in spec]
+            matches = [m for m in INPUT_MATCHES if m in spec]
+            if len(sources) != 1:
+                errors.append(where + ": input %s needs exactly one of %s" % (key, ", ".join(INPUT_SOURCES)))
+            elif sources[0] == "parent-container" and spec["parent-container"] not in PARENT_CONTAINERS:
+                errors.append(where + ": input %s has unknown parent-container %s" % (key, spec["parent-container"]))
+            elif sources[0] == "find-analysis-label" and ":" not in spec["find-analysis-label"]:
+                errors.append(where + ": input %s find-analysis-label must be 'gear:label'" % key)
+            if sources and sources[0] == "parent-container" and len(matches) != 1:
+                errors.append(where + ": input %s needs exactly one of %s" % (key, ", ".join(INPUT_MATCHES)))
+            if "regex" in spec and not PLACEHOLDER.search(spec["regex"]):
+                try:
+                    _compile(spec["regex"])
+                except re.error as e:
+                    errors.append(where + ": input %s has invalid regex (%s)" % (key, e))
+    return errors
+
+
+def compile_inputs(step):
+    """Pre-parses the `inputs` of one template step.
+
+    Regexes without {SUBJECT}/{SESSION} placeholders are compiled once here;
+    the others are compiled (and cached) per distinct substituted pattern.
+
+    Returns:
+        list: InputSpec entries, None if the step takes no inputs.
+    """
+    if "inputs" not in step:
+        return None
+
+    specs = []
+    for key, spec in step["inputs"].items():
+        source = next(s for s in INPUT_SOURCES if s in spec)
+        match = next((m for m in INPUT_MATCHES if m in spec), None)
+        pattern = spec[match] if match else None
+        static = pattern is not None and not PLACEHOLDER.search(pattern)
+        if match == "regex" and static:
+            pattern = _compile(pattern)
+        specs.append(InputSpec(key, source, spec[source], match, pattern, static, spec.get("optional") == True))
+    return specs
+
+
+def input_pattern(spec, session):
+    """Returns the filename (value) or compiled regex of an input for one session."""
+    if spec.static:
+        return spec.pattern
+    lookup_table = {"SUBJECT": session.subject.label, "SESSION": session.label}
+    text = PLACEHOLDER.sub(lambda m: lookup_table[m.group(1)], spec.pattern)
+    return _compile(text) if spec.match == "regex" else text
+
+
+class CompiledTemplate:
+    """A gears template validated and pre-parsed once, shared by every session in a sweep.
+
+    Args:
+        template (dict): gears template (see 2_gear_autoworkflow/README.md).
+        version (str): template version (file hash), used as cache key.
+
+    Raises:
+        ValueError: if the template is invalid or prerequisites form a cycle.
+    """
+
+    def __init__(self, template, version=None):
+        errors = validate_template(template)
+        if errors:
+            raise ValueError("; ".join(errors))
+        self.template = template
+        self.version = version
+        self.steps = template["analysis"]
+        self.deps = build_template_graph(template)
+        self.inputs = [compile_inputs(step) for step in self.steps]
@@ -0,0 +1,174 @@
+"""
+Batched, concurrent uploads to flywheel containers.
+
+Files are queued per container and uploaded on a shared thread pool. Each
+container is then re-read with exponential backoff (not once per file and
+second) until all of its new files show up, and only then are the requested
+info / metadata updates applied. Per-file latency and overall throughput
+are reported at the end.
+
+    with UploadPipeline(max_workers=8) as pipeline:
+        for png in pngs:
+            pipeline.add(acquisition, png, overwrite=True, tags=["qc"])
+    log.info(pipeline.report())
+"""
+
+import os
+import time
+import logging
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from _helper_functions.client import get_client
+
+log = logging.getLogger(__name__)
+
+Upload = namedtuple("Upload", ["path", "name", "overwrite", "update", "replace_info", "kwargs"])
+
+
+class UploadPipeline:
+    """Uploads queued files per container, confirms them, then applies metadata updates.
+
+    Args:
+        max_workers (int): files uploaded at the same time (across containers).
+        max_containers (int): containers processed at the same time.
+        confirm_timeout (float): seconds to wait for uploaded files to show up in their container.
+        backoff (float): first confirmation delay in seconds, doubled after every check (capped at 10 s).
+        client (flywheel.Client): client used to delete files that are overwritten (default: the shared client).
+    """
+
+    def __init__(self, max_workers=4, max_containers=4, confirm_timeout=120, backoff=0.5, client=None):
+        self.max_workers = max_workers
+        self.max_containers = max_containers
+        self.confirm_timeout = confirm_timeout
+        self.backoff = backoff
+        self.client = client or get_client()
+        self.results = []
+        self.errors = {}
+        self._queues = OrderedDict()
+        self._containers = {}
+        self._elapsed = 0.0
+
+    def add(self, container, fp, overwrite=False, update=True, replace_info=None, **kwargs):
+        """Queues a file for upload (see fileIO.upload_file_to_container for the arguments)."""
+        if not os.path.isfile(fp):
+            raise ValueError(f'{fp} is not file.')
+        self._containers[container.id] = container
+        self._queues.setdefault(container.id, []).append(
+            Upload(fp, os.path.basename(fp), overwrite, update, replace_info, kwargs))
+
+    def run(self):
+        """Uploads everything queued so far; returns the per-file results."""
+        queues, self._queues = self._queues, OrderedDict()
+        if not queues:
+            return self.results
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as upload_pool, \
+                ThreadPoolExecutor(max_workers=max(1, self.max_containers)) as container_pool:
+            futures = {container_pool.submit(self._process_container, self._containers[cid], uploads, upload_pool): cid
+                       for cid, uploads in queues.items()}
+            for future, cid in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error("Uploads to container %s failed: %s", cid, e)
+                    self.errors[cid] = e
+        self._elapsed += time.perf_counter() - start
+        return self.results
+
+    def _process_container(self, container, uploads, upload_pool):
+        # files already there: skip, or delete and remember the old version to tell the new one apart
+        existing = {f.name: f for f in container.files}
+        previous = {}
+        todo = []
+        for upload in uploads:
+            if upload.name in existing and not upload.overwrite:
+                log.info(f'File {upload.name} already exists in container. Skipping.')
+                self._record(container, upload, "skipped")
+                continue
+            if upload.name in existing:
+                log.info(f'File {upload.name} already exists, overwriting.')
+                previous[upload.name] = _file_version(existing[upload.name])
+                self.client.delete_container_file(container.id, upload.name)
+            todo.append(upload)
+
+        started = {}
+
+        def upload_one(upload):
+            started[upload.name] = time.perf_counter()
+            log.info(f'Uploading {upload.path} to container {container.id}')
+            container.upload_file(upload.path)
+
+        failed = {}
+        for upload, future in [(u, upload_pool.submit(upload_one, u)) for u in todo]:
+            try:
+                future.result()
+            except Exception as e:
+                failed[upload.name] = e
+                self._record(container, upload, "failed", error=e)
+        todo = [u for u in todo if u.name not in failed]
+
+        # confirm all new files of this container with one reload per check
+        confirmed = {}
+        delay, deadline = self.backoff, time.perf_counter() + self.confirm_timeout
+        while todo and len(confirmed) < len(todo):
+            files = {f.name: f for f in container.files}
+            for upload in todo:
+                f = files.get(upload.name)
+                if upload.name not in confirmed and f is not None and _file_version(f) != previous.get(upload.name):
+                    confirmed[upload.name] = time.perf_counter()
+            if len(confirmed) == len(todo) or time.perf_counter() > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+            container = container.reload()
+
+        for upload in todo:
+            if upload.name not in confirmed:
+                log.warning(f'File {upload.name} did not show up in container {container.id} '
+                            f'within {self.confirm_timeout} s, metadata not updated.')
+                self._record(container, upload, "unconfirmed", started=started[upload.name])
+                continue
+            f = container.get_file(upload.name)
+            if upload.replace_info:
+                f.replace_info(upload.replace_info)
+                log.info(f'Replacing info {list(upload.replace_info.keys())} of file {upload.name} in container {container.id}')
+            if upload.update and upload.kwargs:
+                f.update(**upload.kwargs)
+            self._record(container, upload, "uploaded", started=started[upload.name], confirmed=confirmed[upload.name])
+
+    def _record(self, container, upload, status, started=None, confirmed=None, error=None):
+        latency = confirmed - started if started and confirmed else None
+        self.results.append({"container": container.id, "file": upload.name, "status": status,
+                             "bytes": os.path.getsize(upload.path), "latency": latency, "error": error})
+
+    def report(self):
+        """Returns counts per status, MB uploaded, throughput and per-file latency stats."""
+        uploaded = [r for r in self.results if r["status"] == "uploaded"]
+        latencies = sorted(r["latency"] for r in uploaded)
+        size = sum(r["bytes"] for r in uploaded)
+        report = {status: sum(r["status"] == status for r in self.results)
+                  for status in ("uploaded", "skipped", "failed", "unconfirmed")}
+        report.update({"MB": round(size / 1e6, 1), "seconds": round(self._elapsed, 1),
+                       "MB/s": round(size / 1e6 / self._elapsed, 2) if self._elapsed else None,
+                       "files/s": round(len(uploaded) / self._elapsed, 2) if self._elapsed else None})
+        if latencies:
+            report.update({"latency_median": round(latencies[len(latencies) // 2], 2),
+                           "latency_max": round(latencies[-1], 2)})
+        return report
+
+    def close(self):
+        self.run()
+        log.info("Uploads: %s", self.report())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+
+
+def _file_version(file_entry):
+    # distinguishes a re-uploaded file from the one it replaces
+    return getattr(file_entry, "version", None), getattr(file_entry, "modified", None)
@@ -1,18 +1,22 @@
 from pathlib import Path
-import subprocess as sp
 import sys, os, logging
 import flywheel
 from datetime import datetime, date
 import glob
 import pandas as pd
 from time import sleep
-import time
 import re
 import tempfile
 from zipfile import ZipFile
 import json
-
-fw = flywheel.Client('')
+import mmap
+import shutil
+import locale
+from _helper_functions.jobs import JobWatcher, TERMINAL_STATES
+from _helper_functions.client import get_client
+from _helper_functions.file_discovery import searchfiles  # noqa: F401, re-exported for existing callers
+
+fw = get_client()
 log = logging.getLogger(__name__)
 
 
@@ -43,30 +47,33 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
         return gear_job_id
     except flywheel.rest.ApiException:
         log.exception('An exception was raised when attempting to submit a job for %s',
-                      gear_job_id.name)
+                      gear['gear']['name'])
         
         
 
 def holdjob(jobids, timeout, period=0.25):
-    mustend = time.time() + timeout
-    while time.time() < mustend:
-        if isinstance(jobids, str):
-            jobid =  [jobids]
-        
-        for jid in jobids:
-            anlys = fw.get_job(jid)
-            
-            if any(anlys.state.lower() == s for s in ['complete','cancelled','failed']): 
-                log.info('Job %s: completed with status: %s', anlys.id, anlys.state) 
-                jobids.remove(jid)
-        
-        if isempty(jobids):
-            return True
-    
-        time.sleep(period)
-        log.info('Job %s: timeout after %s seconds... continuing run script', jobid.id, timeout)
-        
-    return False
+    """Waits for one or more flywheel jobs to finish.
+
+    Thin wrapper over jobs.JobWatcher: all jobs are polled together with one
+    batched query, backing off from `period` while nothing changes.
+
+    Args:
+        jobids (str or list): flywheel job id(s).
+        timeout (float): seconds to wait before giving up.
+        period (float): shortest wait between polls, seconds.
+
+    Returns:
+        bool: True if every job finished (complete, cancelled or failed) within the timeout.
+    """
+    if isinstance(jobids, str):
+        jobids = [jobids]
+
+    watcher = JobWatcher(fw, min_period=period)
+    for jid in jobids:
+        watcher.watch(jid, timeout=timeout)
+    states = watcher.wait(timeout=timeout)
+
+    return all(state in TERMINAL_STATES for state in states.values())
 
 
 def hasacquisition(session,acq_name):
@@ -77,52 +84,133 @@ def hasacquisition(session,acq_name):
     return False
 
 
-def searchfiles(path, dryrun=False, find_first=False):
-    cmd = "ls -d " + path
+# files at least this large are scanned through mmap
+MMAP_THRESHOLD = 8 * 1024 * 1024
+
 
-    log.debug("\n %s", cmd)
+def _compile_prefilters(compiled, encoding):
+    # bytes versions of the patterns, matching wherever the originals may match; None if one cannot be converted
+    try:
+        if not all(p.pattern.isascii() for p in compiled):
+            return None
+        return [re.compile(p.pattern.encode(encoding), re.MULTILINE) for p in compiled]
+    except (re.error, UnicodeEncodeError, LookupError):
+        return None
+
+
+def _candidate_lines(buf, prefilters):
+    # (start, end) byte offsets of the lines any prefilter matches, in file order; end includes the newline
+    starts = set()
+    for prefilter in prefilters:
+        pos = 0
+        while True:
+            match = prefilter.search(buf, pos)
+            if match is None:
+                break
+            start = buf.rfind(b"\n", 0, match.start()) + 1
+            end = buf.find(b"\n", match.start())
+            end = len(buf) if end == -1 else end + 1
+            starts.add((start, end))
+            if end >= len(buf):
+                break
+            pos = end
+    return sorted(starts)
+
+
+def scan_file(filename, patterns=None, replacements=None, encoding=None, mmap_threshold=MMAP_THRESHOLD):
+    """Finds several patterns and replaces several lines of a text file in one pass.
+
+    The file is read once and each line is checked against all patterns. `patterns` collect, like
+    locate_by_pattern, the first match of each matching line; `replacements`
+    replace, like replace_line, every line matching their regex by their text
+    (the first matching replacement wins). Files of at least `mmap_threshold`
+    bytes are memory-mapped, each pattern is searched through the whole buffer and
+    only the lines they hit are decoded.
+    Edits are written once, atomically (temporary file + os.replace), keeping the
+    file's permissions.
 
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
+    Args:
+        filename (str): text file (e.g. a FEAT design.fsf or a log file).
+        patterns (dict): {name: regex} to collect.
+        replacements (dict): {name: (regex, replacement line)} to apply.
+        encoding (str): file encoding (default: the locale's, like open()).
+        mmap_threshold (int): smallest file size, in bytes, scanned through mmap.
+
+    Returns:
+        dict: {name: list}, the matches of each pattern and the original lines
+        replaced by each replacement.
+    """
+    patterns = patterns or {}
+    replacements = replacements or {}
+    encoding = encoding or locale.getpreferredencoding(False)
+    found = {name: re.compile(pattern) for name, pattern in patterns.items()}
+    edits = {name: (re.compile(pattern), repl) for name, (pattern, repl) in replacements.items()}
+    results = {name: [] for name in list(found) + list(edits)}
+
+    def scan_line(line):
+        # returns the replacement text of the line, None to keep it
+        for name, pattern in found.items():
+            matches = pattern.findall(line)
+            if matches:
+                results[name].append(matches[0])
+        for name, (pattern, repl) in edits.items():
+            if pattern.search(line):
+                results[name].append(line)
+                return repl
+        return None
+
+    size = os.path.getsize(filename)
+    prefilters = _compile_prefilters(list(found.values()) + [p for p, _ in edits.values()], encoding)
+    out = []
+    changed = False
+    if size >= mmap_threshold and size and prefilters:
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            last = 0
+            for start, end in _candidate_lines(buf, prefilters):
+                repl = scan_line(buf[start:end].decode(encoding).replace("\r\n", "\n"))
+                if repl is not None:
+                    out.append(buf[last:start])
+                    out.append(repl.encode(encoding))
+                    last = end
+                    changed = True
+            if changed:
+                out.append(buf[last:])
+    else:
+        with open(filename, encoding=encoding) as src_file:
+            for line in src_file:
+                repl = scan_line(line)
+                changed = changed or repl is not None
+                out.append(line if repl is None else repl)
+        out = [chunk.encode(encoding) for chunk in out] if changed else []
 
-        files = stdout.strip("\n").split("\n")
+    if changed:
+        _atomic_write(filename, out)
+    return results
 
-        if find_first:
-            files = files[0]
 
-        return files
+def _atomic_write(filename, chunks):
+    # temporary file in the same directory, so os.replace is an atomic rename
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                    prefix="." + os.path.basename(filename) + ".")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.writelines(chunks)
+        shutil.copystat(filename, tmp_name)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
 
 
 def replace_line(filename, pattern, repl):
     """
         Perform the pure-Python equivalent of in-place `sed` substitution: e.g.,
         `sed -i -e 's/'${pattern}'/'${repl}' "${filename}"`.
-        """
-    # For efficiency, precompile the passed regular expression.
-    pattern_compiled = re.compile(pattern)
-
-    # For portability, NamedTemporaryFile() defaults to mode "w+b" (i.e., binary
-    # writing with updating). This is usually a good thing. In this case,
-    # however, binary writing imposes non-trivial encoding constraints trivially
-    # resolved by switching to text writing. Let's do that.
-    with tempfile.NamedTemporaryFile(dir=os.getcwd(), mode='w', delete=False) as tmp_file:
-        with open(filename) as src_file:
-            for line in src_file:
-                if re.findall(pattern_compiled, line):
-                    tmp_file.write(repl)
-                else:
-                    tmp_file.write(line)
-
-    # Overwrite the original file with the munged temporary file in a
-    # manner preserving file attributes (e.g., permissions).
-    shutil.copystat(filename, tmp_file.name)
-    shutil.move(tmp_file.name, filename)
 
+        Every line matching `pattern` is replaced by `repl`. The file is rewritten
+        atomically; to make several substitutions use scan_file (one read, one write).
+        """
+    scan_file(filename, replacements={"repl": (pattern, repl)})
 
 
 def locate_by_pattern(filename, pattern):
@@ -133,18 +221,9 @@ def locate_by_pattern(filename, pattern):
         pattern: regex
 
     Returns:
-
+        list: first match of each matching line (use scan_file to look up several patterns in one pass)
     """
-    # For efficiency, precompile the passed regular expression.
-    pattern_compiled = re.compile(pattern)
-    arr = []
-    with open(filename) as src_file:
-        for line in src_file:
-            num = re.findall(pattern_compiled, line)
-            if num:
-                arr.append(num[0])
-
-    return arr
+    return scan_file(filename, patterns={"pattern": pattern})["pattern"]
 
 
 def create_file(filename):
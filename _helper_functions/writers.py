@@ -0,0 +1,255 @@
+"""
+Append-only table writers with resume support.
+
+Rows are written as they are produced, grouped by a key column (the session
+id for the reporting tables). A group is only recorded as done once all of
+its rows are on disk, so an interrupted run can resume after the last
+complete group, without duplicate or partial rows.
+
+    with table_writer("gear_table.csv", tables.GEARNAME_COLUMNS, key="session.id") as writer:
+        writer.write_rows(rows)
+"""
+
+import os
+import csv
+import glob
+import logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+log = logging.getLogger(__name__)
+
+
+class CSVTableWriter:
+    """Appends rows to a csv file, recording progress in a `<path>.progress` file.
+
+    The progress file lists each completed key with the csv file size after its
+    rows. On resume the csv is cut back to the last recorded size, dropping the
+    rows of a group that was interrupted.
+
+    Args:
+        path (str): csv file.
+        columns (list): column names, in order.
+        key (str): column grouping the rows (rows of one group must be consecutive).
+        resume (bool): continue an existing file; if False (or without progress file) start over.
+    """
+
+    def __init__(self, path, columns, key="session.id", resume=True):
+        self.path = path
+        self.columns = list(columns)
+        self.key = key
+        self.progress_path = path + ".progress"
+        self.done = set()
+        self.rows_written = 0
+        self._current = None
+        self._pending = []
+
+        offset = 0
+        if resume and os.path.exists(self.progress_path) and os.path.exists(path):
+            with open(self.progress_path) as f:
+                for line in f:
+                    done_key, _, size = line.rstrip("\n").rpartition("\t")
+                    if size.isdigit():
+                        self.done.add(done_key)
+                        offset = int(size)
+        else:
+            for stale in (path, self.progress_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+        self._file = open(path, "a+", newline="")
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        self._writer = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction="ignore")
+        self._progress = open(self.progress_path, "a" if offset else "w")
+        if offset == 0:
+            # header, recorded with an empty key
+            self._writer.writeheader()
+            self._file.flush()
+            self._progress.write("\t%s\n" % self._file.tell())
+            self._progress.flush()
+        self.done.discard("")
+
+        if self.done:
+            log.info("resuming %s after %s completed groups", path, len(self.done))
+
+    def write(self, row):
+        if self._current is not None and row[self.key] != self._current:
+            self.commit()
+        self._current = row[self.key]
+        self._pending.append(row)
+
+    def write_rows(self, rows):
+        """Writes all rows of an iterable; returns the number of rows."""
+        n = 0
+        for n, row in enumerate(rows, 1):
+            self.write(row)
+        self.commit()
+        return n
+
+    def mark_done(self, key):
+        """Records a group that produced no rows."""
+        self.commit()
+        self._current = key
+        self.commit()
+
+    def commit(self):
+        """Writes the current group and records it as done."""
+        if self._current is None:
+            return
+        self._writer.writerows(self._pending)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._progress.write("%s\t%s\n" % (self._current, self._file.tell()))
+        self._progress.flush()
+        self.done.add(str(self._current))
+        self.rows_written += len(self._pending)
+        self._current, self._pending = None, []
+
+    def close(self):
+        self.commit()
+        self._file.close()
+        self._progress.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # only commit the open group if it completed without an error
+        if exc[0] is not None:
+            self._current, self._pending = None, []
+        self.close()
+
+
+class ParquetTableWriter:
+    """Appends rows to a parquet dataset (a directory of part files), requires pyarrow.
+
+    Complete groups are buffered and written as one part file once `rows_per_part`
+    rows are collected. Part files are written under a temporary name and renamed,
+    so the keys found in the directory are exactly the completed groups.
+
+    Column types are inferred by pyarrow from the first part (or read from the
+    existing parts on resume) and every later part is written with the same
+    schema. Columns that are empty or hold mixed types in the first part are
+    stored as strings.
+
+    Args:
+        path (str): dataset directory.
+        columns (list): column names, in order.
+        key (str): column grouping the rows (rows of one group must be consecutive).
+        resume (bool): continue an existing dataset; if False start over.
+        rows_per_part (int): rows per part file.
+        schema (pyarrow.Schema): column types to use instead of inferring them.
+    """
+
+    def __init__(self, path, columns, key="session.id", resume=True, rows_per_part=1000, schema=None):
+        if pq is None:
+            raise ImportError("writing parquet tables requires pyarrow (pip install pyarrow)")
+        self.path = path
+        self.columns = list(columns)
+        self.key = key
+        self.rows_per_part = rows_per_part
+        self.schema = schema
+        self.done = set()
+        self.rows_written = 0
+        self._current = None
+        self._pending = []
+        self._buffer = []
+        self._done_keys = []
+
+        os.makedirs(path, exist_ok=True)
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        for part in parts:
+            if resume:
+                if self.schema is None:
+                    self.schema = pq.read_schema(part).remove_metadata()
+                self.done.update(str(k) for k in pq.read_table(part, columns=[key]).column(key).to_pylist())
+                self.done.update(pq.read_metadata(part).metadata.get(b"empty_keys", b"").decode().split("\t"))
+            else:
+                os.remove(part)
+        self.done.discard("")
+        self._part = len(parts) if resume else 0
+
+    def write(self, row):
+        if self._current is not None and row[self.key] != self._current:
+            self.commit()
+        self._current = row[self.key]
+        self._pending.append(row)
+
+    def write_rows(self, rows):
+        n = 0
+        for n, row in enumerate(rows, 1):
+            self.write(row)
+        self.commit()
+        return n
+
+    def mark_done(self, key):
+        self.commit()
+        self._done_keys.append(str(key))
+
+    def commit(self):
+        if self._current is not None:
+            self._buffer.extend(self._pending)
+            self._current, self._pending = None, []
+        if len(self._buffer) >= self.rows_per_part:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer and not self._done_keys:
+            return
+        table = self._table().replace_schema_metadata({"empty_keys": "\t".join(self._done_keys)})
+        part = os.path.join(self.path, "part-%05d.parquet" % self._part)
+        pq.write_table(table, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self.done.update(str(row[self.key]) for row in self._buffer)
+        self.done.update(self._done_keys)
+        self.rows_written += len(self._buffer)
+        self._buffer, self._done_keys = [], []
+        self._part += 1
+
+    def _table(self):
+        data = {column: [row[column] for row in self._buffer] for column in self.columns}
+        if self.schema is None:
+            self.schema = pa.schema([pa.field(column, _column_type(values)) for column, values in data.items()])
+        arrays = []
+        for field in self.schema:
+            values = data[field.name]
+            if pa.types.is_string(field.type):
+                values = [None if value is None else str(value) for value in values]
+            try:
+                arrays.append(pa.array(values, type=field.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                raise ValueError("column %s of %s does not match its type %s: %s" % (field.name, self.path, field.type, e))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def close(self):
+        self.commit()
+        self._flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self._current, self._pending = None, []
+        self.close()
+
+
+def _column_type(values):
+    # type pyarrow infers for a column, string if it is empty or mixes types
+    try:
+        inferred = pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.string()
+    return pa.string() if pa.types.is_null(inferred) else inferred
+
+
+def table_writer(path, columns, key="session.id", resume=True):
+    """Returns a ParquetTableWriter for `*.parquet` paths, a CSVTableWriter otherwise."""
+    if path.endswith(".parquet"):
+        return ParquetTableWriter(path, columns, key=key, resume=resume)
+    return CSVTableWriter(path, columns, key=key, resume=resume)
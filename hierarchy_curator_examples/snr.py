@@ -400,7 +400,7 @@ if __name__ == "__main__":
 
 import os
 import tempfile
-import subprocess as sp
+import fnmatch
 import backoff
 import shutil
 from flywheel.rest import ApiException
@@ -455,18 +455,12 @@ class Curator(HierarchyCurator):
                 # run main from above...                
                 main(Path(path), Path(temp), self.additional_input_one)
 
-                # list of files to upload
-                searchfiles = sp.Popen(
-                    "cd " + temp + "; ls *.tsv *.zip",
-                    shell=True,
-                    stdout=sp.PIPE,
-                    stderr=sp.PIPE, universal_newlines=True
-                )
-                stdout, _ = searchfiles.communicate()
-
-                filelist = stdout.strip("\n").split("\n")
+                # list the outputs once (in-process, no shell)
+                outputs = sorted(entry.name for entry in os.scandir(temp)
+                                 if not entry.name.startswith(".") and entry.name != file_.name)
 
-                if file_.name in filelist: filelist.remove(file_.name)
+                # list of files to upload
+                filelist = [f for f in outputs if fnmatch.fnmatch(f, "*.tsv") or fnmatch.fnmatch(f, "*.zip")]
 
                 log.info("Uploading files to aquisition %s: \n%s", parent.label, "\n".join(filelist))
 
@@ -476,19 +470,7 @@ class Curator(HierarchyCurator):
                     self.robust_upload(parent, os.path.join(temp, f), reset_flag, add_bids_info=True)
 
                 # move output files to outputs folder
-                searchfiles = sp.Popen(
-                    "cd " + temp + "; ls * ",
-                    shell=True,
-                    stdout=sp.PIPE,
-                    stderr=sp.PIPE, universal_newlines=True
-                )
-                stdout, _ = searchfiles.communicate()
-
-                filelist = stdout.strip("\n").split("\n")
-
-                if file_.name in filelist: filelist.remove(file_.name)
-
-                for f in filelist:
+                for f in outputs:
                     shutil.move(os.path.join(temp, f), os.path.join('/flywheel/v0/output/', f))
 
     def robust_upload(self, parent, filepath, reset=False, add_bids_info=False):